@@ -0,0 +1,160 @@
+#
+# Copyright (C) 2012  Per Myren
+#
+# This file is part of Bryton-GPS-Linux
+#
+# Bryton-GPS-Linux is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Bryton-GPS-Linux is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Bryton-GPS-Linux.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+Device images stored as manifests of block hashes.
+
+The blocks are kept once in a shared directory named by the sha1 of
+their data, so successive dumps of a device only add the blocks that
+have changed. A manifest lists the hash of each block of an image,
+and the image is read back lazily one block at a time.
+"""
+
+import os
+import hashlib
+import zlib
+
+from image_file import BLOCK_SIZE, ERASED_BLOCK, BlockImage, has_magic
+from utils import write_file_atomic
+
+MAGIC = 'BRYTNMAN'
+VERSION = 1
+
+# Erased blocks are not stored.
+_ERASED_HASH = '-'
+
+
+def is_manifest(f):
+    return has_magic(f, MAGIC)
+
+
+class BlockStore(object):
+    """
+    A directory of unique blocks, each stored compressed in a file
+    named by the sha1 of the block.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _path(self, block_hash):
+        return os.path.join(self.path, block_hash[:2], block_hash[2:])
+
+    def load(self, block_hash):
+
+        if block_hash == _ERASED_HASH:
+            return ERASED_BLOCK
+
+        try:
+            with open(self._path(block_hash), 'rb') as f:
+                data = f.read()
+        except IOError:
+            raise IOError('Block {0} is missing in "{1}".'.format(
+                block_hash, self.path))
+
+        try:
+            block = zlib.decompress(data)
+        except zlib.error:
+            block = None
+
+        if block is None or hashlib.sha1(block).hexdigest() != block_hash:
+            raise IOError('Block {0} is corrupt in "{1}".'.format(
+                block_hash, self.path))
+
+        return block
+
+    def save(self, block):
+        """Stores the block if it's new and returns (hash, is_new)."""
+
+        if block == ERASED_BLOCK:
+            return _ERASED_HASH, False
+
+        block_hash = hashlib.sha1(block).hexdigest()
+        path = self._path(block_hash)
+
+        if os.path.exists(path):
+            return block_hash, False
+
+        write_file_atomic(path, zlib.compress(block, 9))
+
+        return block_hash, True
+
+    def add(self, manifest_path, data, serial=''):
+        """
+        Stores the blocks of the raw image data and writes a manifest
+        for it. Returns the number of new blocks.
+        """
+
+        hashes = []
+        new = 0
+
+        for offset in xrange(0, len(data), BLOCK_SIZE):
+            block_hash, is_new = self.save(data[offset:offset + BLOCK_SIZE])
+            hashes.append(block_hash)
+            new += is_new
+
+        store = os.path.relpath(self.path,
+                                os.path.dirname(os.path.abspath(
+                                    manifest_path)))
+
+        lines = ['{0} {1}'.format(MAGIC, VERSION),
+                 'store {0}'.format(store),
+                 'serial {0}'.format(serial.encode('hex'))]
+
+        write_file_atomic(manifest_path, '\n'.join(lines + hashes) + '\n')
+
+        return new
+
+
+
+class ManifestImage(BlockImage):
+    """The image listed in a manifest, with the blocks in its store."""
+
+    def __init__(self, f):
+
+        lines = f.read().splitlines()
+
+        try:
+            magic, version = lines[0].split()
+            store = lines[1].split(' ', 1)
+            serial = lines[2].split(' ', 1)
+        except (IndexError, ValueError):
+            raise RuntimeError('Invalid manifest.')
+
+        if magic != MAGIC or store[0] != 'store' or serial[0] != 'serial':
+            raise RuntimeError('Invalid manifest.')
+        if version != str(VERSION):
+            raise RuntimeError('Unsupported manifest version {0}.'.format(
+                version))
+
+        path = os.path.join(os.path.dirname(os.path.abspath(f.name)),
+                            store[1])
+
+        try:
+            self.serial = serial[1].decode('hex') if len(serial) > 1 else ''
+        except TypeError:
+            raise RuntimeError('Invalid manifest.')
+
+        self.store = BlockStore(path)
+        self.hashes = lines[3:]
+        self.block_count = len(self.hashes)
+
+    def block(self, nr):
+        return self.store.load(self.hashes[nr])
@@ -27,9 +27,13 @@ import datetime
 import os
 import getpass
 import time
+import json
+import multiprocessing
+import cStringIO as StringIO
 
 from functools import partial
 from itertools import chain
+from collections import OrderedDict
 
 import rider40
 import gpx
@@ -38,6 +42,7 @@ import json_export
 import strava
 
 from common import print_msg
+from utils import export_track
 
 
 def find_device():
@@ -56,7 +61,7 @@ def find_device():
 def get_device(dev):
 
 
-    data = dev.read_addr(6, 1, 0x10).tostring()
+    data = buffer(dev.read_addr(6, 1, 0x10))[:]
 
     if not data.startswith('Hera Data'):
         return None
@@ -72,7 +77,11 @@ def get_device(dev):
 
 def open_device(dev_path):
     import device_access
-    dev_access = device_access.DeviceAccess(dev_path)
+    if os.path.isfile(dev_path):
+        # A raw image created by dump.py
+        dev_access = device_access.ImageAccess(dev_path)
+    else:
+        dev_access = device_access.DeviceAccess(dev_path)
     dev_access.open()
     return contextlib.closing(dev_access)
 
@@ -88,6 +97,34 @@ def get_tracks(history, track_ids):
     return tracks
 
 
+def parse_time(value):
+    """Parses a local time given as YYYY-MM-DD [HH:MM[:SS]]."""
+
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return int(time.mktime(time.strptime(value, fmt)))
+        except ValueError:
+            pass
+
+    raise argparse.ArgumentTypeError(
+        'Invalid time {0!r}, use YYYY-MM-DD [HH:MM[:SS]]'.format(value))
+
+
+def set_time_window(tracks, start, end, adjustment=None):
+    """
+    Only the points between start and end will be read. The times
+    are as they will be after the time is adjusted with --adj-time.
+    """
+
+    if adjustment:
+        adjustment = adjustment * 60 * 60
+        start = start - adjustment if start is not None else None
+        end = end - adjustment if end is not None else None
+
+    for t in tracks:
+        t.time_window = (start, end)
+
+
 def print_history(history, print_storage=False):
 
     if not history:
@@ -176,46 +213,136 @@ def _print_storage_row(u, key, title):
 
 
 
-def export_tracks(tracks, export_func, file_ext, args):
+def export_tracks(tracks, exporters, args):
+    """
+    exporters is a list of (exporter, file_ext) where exporter(f, pretty)
+    creates an exporter that writes to the file object f. Each track is
+    only traversed once for all the exporters.
+    """
 
     if args.out_name is not None and len(tracks) > 1:
         raise RuntimeError('--out-name can only be used with a single track.')
 
+    if args.jobs > 1 and len(tracks) > 1:
+        _export_parallel(tracks, exporters, args)
+        return
+
+    for t in tracks:
+        _export_track(t, exporters, args, sys.stdout)
+
+
+def _export_parallel(tracks, exporters, args):
+    """
+    Exports the tracks in a pool of worker processes. The output
+    and errors are handled in the same order as the tracks.
+    """
+
+    # The workers can't access the device, so the tracks are read here.
     for t in tracks:
+        t.read_all()
+
+    pool = multiprocessing.Pool(args.jobs)
+    try:
+        jobs = [(t, exporters, args) for t in tracks]
+        for out in pool.imap(_export_job, jobs):
+            sys.stdout.write(out)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _export_job(job):
+    """Exports a track in a worker process, returns the output to stdout."""
 
-        out = export_func(t, pretty=args.no_whitespace)
+    track, exporters, args = job
 
-        if args.save_to is None and args.out_name is None:
-            print out
-            continue
+    out = StringIO.StringIO()
+    _export_track(track, exporters, args, out)
+    return out.getvalue()
+
+
+def _export_track(track, exporters, args, out):
+
+    if args.save_to is None and args.out_name is None:
+        _export_stdout(track, exporters, args, out)
+        return
+
+    # When more than one format use the same file name the last
+    # one is written.
+    paths = OrderedDict()
+    for exporter, file_ext in exporters:
 
         if args.out_name:
             path = args.out_name
         else:
-            fname = t.name.replace('/', '').replace(':', '') \
+            fname = track.name.replace('/', '').replace(':', '') \
                 .replace(' ', '-') + '.' + file_ext
             path = os.path.join(args.save_to, fname)
 
+        paths.pop(path, None)
+        paths[path] = exporter
 
-        with open(path, 'w') as f:
+    files = []
+    try:
+        for path in paths:
+            files.append(open(path, 'w'))
+
+        export_track(track, [exporter(f, pretty=args.no_whitespace)
+                             for f, exporter in zip(files, paths.values())])
+    finally:
+        for f in files:
+            f.close()
 
-            f.write(out)
 
+def _export_stdout(track, exporters, args, out):
+
+    if len(exporters) == 1:
+        exporter, file_ext = exporters[0]
+        export_track(track, [exporter(out, pretty=args.no_whitespace)])
+        out.write('\n')
+        return
 
-def export_fake_garmin(tracks, args):
+    # The formats are written one after the other.
+    files = [StringIO.StringIO() for e in exporters]
 
-    export_func = partial(tcx.track_to_tcx, fake_garmin_device=True,
-                         no_laps=args.no_laps)
+    export_track(track, [exporter(f, pretty=args.no_whitespace)
+                         for f, (exporter, file_ext) in zip(files, exporters)])
 
-    export_tracks(tracks, export_func, 'tcx', args)
+    for f in files:
+        out.write(f.getvalue())
+        out.write('\n')
+
+
+def _exporters(args):
+
+    exporters = []
+
+    if args.gpx:
+        exporters.append((gpx.PlainGpxExporter, 'gpx'))
+    if args.gpxx:
+        exporters.append((gpx.GarminGpxxExporter, 'gpx'))
+    if args.json:
+        exporters.append((json_export.JsonExporter, 'json'))
+    if args.json_columnar:
+        exporters.append((partial(json_export.JsonExporter, columnar=True),
+                          'json'))
+    if args.tcx:
+        exporters.append((partial(tcx.TcxExporter,
+                                  fake_garmin_device=args.fake_garmin,
+                                  no_laps=args.no_laps), 'tcx'))
+
+    return exporters
 
 
 
 def upload_strava(tracks, args, fake_garmin_device=False):
+    """Returns the tracks that were uploaded."""
+
+    uploaded = []
 
     if args.strava_email is None:
         print_msg('Missing email for strava.com')
-        return
+        return uploaded
 
     password = args.strava_password
     if password is None:
@@ -230,7 +357,7 @@ def upload_strava(tracks, args, fake_garmin_device=False):
         uploader.authenticate(args.strava_email, password)
     except strava.StravaError, e:
         print_msg('StravaError:', e.reason)
-        return
+        return uploaded
 
     for t in tracks:
 
@@ -243,12 +370,15 @@ def upload_strava(tracks, args, fake_garmin_device=False):
                 p = upload.check_progress()
 
             print_msg('Uploaded OK')
+            uploaded.append(t)
 
 
 
         except strava.StravaError, e:
             print_msg('StravaError:', e.reason)
 
+    return uploaded
+
 
 
 def options():
@@ -256,7 +386,8 @@ def options():
     p = argparse.ArgumentParser(description='Bryton GPS Linux')
 
     p.add_argument('--device', '-D',
-                   help='Path to the device. If not specified'
+                   help='Path to the device or to an image created by '
+                        'dump.py. If not specified'
                         ' it will try to be autodetected.')
 
     p.add_argument('--list-history', '-L', action='store_true',
@@ -275,14 +406,37 @@ def options():
                         'of the selected tracks.')
     p.add_argument('--tcx', action='store_true',
                    help='Generate TCX files of the selected tracks.')
-    p.add_argument('--json', action='store_true',
-                   help='Generate JSON files of the selected tracks.')
+    # Both are written to .json files.
+    json_format = p.add_mutually_exclusive_group()
+    json_format.add_argument('--json', action='store_true',
+                             help='Generate JSON files of the selected '
+                                  'tracks.')
+    json_format.add_argument('--json-columnar', action='store_true',
+                             help='Generate JSON files of the selected '
+                                  'tracks with an array for each value '
+                                  'instead of an object for each point.')
     p.add_argument('--save-to', '-S',
                    help='Directory to store expored files.')
     p.add_argument('--out-name', '-O',
                    help='Filename to export to. Only one track.')
     p.add_argument('--no-whitespace', action='store_false',
                    help='No unnecessary whitespace in exported files.')
+    p.add_argument('--from', dest='time_from', type=parse_time,
+                   metavar='TIME',
+                   help='Only export the points recorded at or after TIME '
+                        '(local time, YYYY-MM-DD [HH:MM[:SS]]).')
+    p.add_argument('--to', dest='time_to', type=parse_time, metavar='TIME',
+                   help='Only export the points recorded at or before TIME '
+                        '(local time, YYYY-MM-DD [HH:MM[:SS]]).')
+    p.add_argument('--sync', metavar='DIR',
+                   help='Export the tracks that have not been exported to '
+                        'DIR by an earlier --sync, using the selected '
+                        'formats.')
+    p.add_argument('--no-cache', action='store_true',
+                   help='Read the tracks from the device even if they are '
+                        'in the track cache, and do not store them there.')
+    p.add_argument('--jobs', '-j', type=int, default=1, metavar='N',
+                   help='Export the tracks using N processes.')
 
     p.add_argument('--strava', action='store_true',
                    help='Upload tracks to strava.com')
@@ -348,58 +502,131 @@ def main():
 
         module, device = get_device(dev_access)
 
-        if args.list_history or args.tracks:
+        if args.no_cache:
+            device.track_cache = None
+
+        if args.list_history or args.tracks or args.sync:
             history = list(reversed(module.read_history(device)))
 
 
         if args.list_history:
             print_history(history, args.storage)
 
+        elif args.sync:
+            sync_tracks(module, device, history, args)
+
         elif args.tracks:
 
             tracks = get_tracks(history, args.tracks)
+            module.index_segments(device, tracks)
 
-            if args.adj_time:
-                adjust_time(tracks, args.adj_time)
+            process_tracks(tracks, args)
 
-            if args.summary:
-                print_summaries(tracks, args.storage)
+        elif args.storage:
+            print_storage_usage(device)
+        else:
+            opts.print_help()
 
-            if args.fix_elevation:
-                fix_elevation(tracks, args.fix_elevation)
 
-            if args.strip_elevation:
-                strip_elevation(tracks)
 
-            if args.use_elevation_db:
-                set_elevation_from_db(tracks)
+    return 0
 
-            if args.gpx:
-                export_tracks(tracks, gpx.track_to_plain_gpx, 'gpx', args)
-            if args.gpxx:
-                export_tracks(tracks, gpx.track_to_garmin_gpxx, 'gpx', args)
-            if args.json:
-                export_tracks(tracks, json_export.track_to_json, 'json', args)
-            if args.tcx:
-                if args.fake_garmin:
-                    export_fake_garmin(tracks, args)
-                else:
-                    export_tracks(tracks,
-                              partial(tcx.track_to_tcx, no_laps=args.no_laps),
-                                  'tcx', args)
 
-            if args.strava:
-                upload_strava(tracks, args,
-                              fake_garmin_device=args.fake_garmin)
+def process_tracks(tracks, args):
+    """Returns the tracks that were processed without errors."""
 
-        elif args.storage:
-            print_storage_usage(device)
-        else:
-            opts.print_help()
+    if args.time_from is not None or args.time_to is not None:
+        set_time_window(tracks, args.time_from, args.time_to, args.adj_time)
 
+    if args.adj_time:
+        adjust_time(tracks, args.adj_time)
 
+    if args.summary:
+        print_summaries(tracks, args.storage)
 
-    return 0
+    if args.fix_elevation:
+        fix_elevation(tracks, args.fix_elevation)
+
+    if args.strip_elevation:
+        strip_elevation(tracks)
+
+    if args.use_elevation_db:
+        set_elevation_from_db(tracks)
+
+    exporters = _exporters(args)
+    if exporters:
+        export_tracks(tracks, exporters, args)
+
+    if args.strava:
+        uploaded = upload_strava(tracks, args,
+                                 fake_garmin_device=args.fake_garmin)
+        tracks = [t for t in tracks if t in uploaded]
+
+    return tracks
+
+
+def sync_tracks(module, device, history, args):
+    """
+    Exports the tracks that have not been synced to the directory
+    before. The synced tracks are remembered for each device serial
+    in a file in the directory.
+    """
+
+    if not _exporters(args) and not args.strava:
+        raise RuntimeError('--sync needs at least one export format.')
+
+    # Only whole tracks are synced.
+    if args.time_from is not None or args.time_to is not None:
+        raise RuntimeError('--sync can not be used with --from or --to.')
+
+    path = os.path.join(args.sync, '.brytongps-sync.json')
+    serial = device.read_serial().encode('hex')
+
+    try:
+        with open(path) as f:
+            synced = json.load(f)
+    except IOError:
+        synced = {}
+    except ValueError:
+        raise RuntimeError('Invalid sync file {0}'.format(path))
+
+    done = set(synced.get(serial, []))
+
+    tracks = [t for t in history if _track_id(t) not in done]
+
+    if tracks:
+
+        module.index_segments(device, tracks)
+
+        if not os.path.isdir(args.sync):
+            os.makedirs(args.sync)
+
+        args.save_to = args.sync
+        args.out_name = None
+
+        # The tracks are read first, so a track that can't be read is
+        # left out and tried again the next time.
+        readable = []
+        for t in tracks:
+            try:
+                t.read_all()
+            except RuntimeError as e:
+                print_msg('Error: Failed to read', t.name + ':', e.message)
+                continue
+            readable.append(t)
+
+        tracks = process_tracks(readable, args)
+
+        synced[serial] = sorted(done.union(_track_id(t) for t in tracks))
+
+        with open(path, 'w') as f:
+            json.dump(synced, f, indent=1)
+
+    print_msg('Synced', len(tracks), 'new tracks to', args.sync)
+
+
+def _track_id(track):
+    return '{0}-{1}'.format(*track.key)
 
 
 def strip_elevation(tracks):
@@ -21,6 +21,9 @@ from __future__ import print_function
 
 import sys
 import struct
+import array
+
+from collections import OrderedDict
 
 
 def print_msg(msg, *args):
@@ -67,15 +70,383 @@ class LogPoint(object):
 
 
 
+class TrackPointView(TrackPoint):
+    """
+    A TrackPoint that reads and writes its values from a point
+    in TrackPointColumns.
+    """
+
+    __slots__ = ('_columns', '_index')
+
+    def __init__(self, columns, index):
+        self._columns = columns
+        self._index = index
+
+    @property
+    def timestamp(self):
+        return self._columns.timestamps[self._index]
+
+    @timestamp.setter
+    def timestamp(self, value):
+        self._columns.timestamps[self._index] = value
+
+    @property
+    def longitude(self):
+        return self._columns.longitudes[self._index] / 1000000.0
+
+    @longitude.setter
+    def longitude(self, value):
+        self._columns.longitudes[self._index] = int(round(value * 1000000))
+
+    @property
+    def latitude(self):
+        return self._columns.latitudes[self._index] / 1000000.0
+
+    @latitude.setter
+    def latitude(self, value):
+        self._columns.latitudes[self._index] = int(round(value * 1000000))
+
+    @property
+    def elevation(self):
+        c = self._columns
+        if c.int_elevations is not None and c.int_elevations[self._index]:
+            return int(c.elevations[self._index])
+        return c.elevations[self._index]
+
+    @elevation.setter
+    def elevation(self, value):
+        self._columns.set_elevation(self._index, value)
+
+
+
+def _logpoint_property(name, missing=None):
+
+    def get(self):
+        c = self._columns
+        if c.valid[name][self._index]:
+            return c.values[name][self._index]
+        return missing
+
+    def set(self, value):
+        c = self._columns
+        c.valid[name][self._index] = value is not None
+        c.values[name][self._index] = value if value is not None else 0
+
+    return property(get, set)
+
+
+
+class LogPointView(LogPoint):
+    """
+    A LogPoint that reads and writes its values from a point
+    in LogPointColumns.
+    """
+
+    __slots__ = ('_columns', '_index')
+
+    def __init__(self, columns, index):
+        self._columns = columns
+        self._index = index
+
+    @property
+    def timestamp(self):
+        return self._columns.timestamps[self._index]
+
+    @timestamp.setter
+    def timestamp(self, value):
+        self._columns.timestamps[self._index] = value
+
+    # The speed is 0 when it's not available.
+    speed = _logpoint_property('speed', 0)
+    watts = _logpoint_property('watts')
+    cadence = _logpoint_property('cadence')
+    heartrate = _logpoint_property('heartrate')
+    temperature = _logpoint_property('temperature')
+    airpressure = _logpoint_property('airpressure')
+
+
+
+def _pack_array(a):
+    return a.typecode, a.tostring()
+
+
+def _unpack_array(packed):
+    typecode, data = packed
+    a = array.array(typecode)
+    a.fromstring(data)
+    return a
+
+
+
+class _Columns(object):
+
+    _view = None
+
+    # Arrays are pickled as lists by default, the columns are pickled a
+    # lot faster and smaller as the machine values. The pickles are only
+    # read on the same machine, by the track cache and the export
+    # processes.
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+
+        arrays = {}
+        for name, value in self.__dict__.iteritems():
+            if isinstance(value, array.array):
+                arrays[name] = _pack_array(state.pop(name))
+
+        state['_arrays'] = arrays
+        return state
+
+    def __setstate__(self, state):
+
+        state = state.copy()
+
+        for name, packed in state.pop('_arrays').iteritems():
+            state[name] = _unpack_array(packed)
+
+        self.__dict__.update(state)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, index):
+
+        if isinstance(index, slice):
+            return [self._view(self, i)
+                    for i in xrange(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('point index out of range')
+
+        return self._view(self, index)
+
+    def __iter__(self):
+        view = self._view
+        for i in xrange(len(self)):
+            yield view(self, i)
+
+
+
+class TrackPointColumns(_Columns):
+    """
+    Trackpoints stored with one array for each value, the positions
+    in microdegrees. TrackPoint objects are only created when the
+    points are accessed.
+    """
+
+    _view = TrackPointView
+
+    # An array with a byte for each point, set for the elevations that
+    # were set to ints. They are read back as ints like they were when
+    # the points were objects. None until an int is set.
+    int_elevations = None
+
+    def __init__(self):
+        self.timestamps = array.array('l')
+        self.longitudes = array.array('i')
+        self.latitudes = array.array('i')
+        self.elevations = array.array('d')
+
+    def add(self, timestamp, longitude, latitude, elevation):
+        """Add a point. The longitude and latitude are in microdegrees."""
+        self.timestamps.append(timestamp)
+        self.longitudes.append(longitude)
+        self.latitudes.append(latitude)
+        self.elevations.append(elevation)
+        if self.int_elevations is not None:
+            self.int_elevations.append(0)
+
+    def extend_arrays(self, timestamps, longitudes, latitudes, elevations):
+        self.timestamps.extend(timestamps)
+        self.longitudes.extend(longitudes)
+        self.latitudes.extend(latitudes)
+        self.elevations.extend(elevations)
+        if self.int_elevations is not None:
+            self.int_elevations.extend(
+                array.array('B', [0]) * len(elevations))
+
+    def set_elevation(self, index, value):
+
+        self.elevations[index] = value
+
+        is_int = isinstance(value, (int, long))
+
+        if self.int_elevations is None:
+            if not is_int:
+                return
+            self.int_elevations = array.array('B', [0]) * len(self)
+
+        self.int_elevations[index] = is_int
+
+    def elevation_list(self):
+        """The elevations as a list, the ints set as ints."""
+
+        values = self.elevations.tolist()
+
+        if self.int_elevations is not None:
+            values = [int(v) if is_int else v
+                      for v, is_int in zip(values, self.int_elevations)]
+
+        return values
+
+
+
+class LogPointColumns(_Columns):
+    """
+    Logpoints stored with one array for each value. Each value
+    except the timestamp has an array which tells if the value is
+    available. LogPoint objects are only created when the points
+    are accessed.
+    """
+
+    _view = LogPointView
+
+    # The values and their array type codes.
+    FIELDS = (('speed', 'd'), ('watts', 'H'), ('cadence', 'B'),
+              ('heartrate', 'B'), ('temperature', 'd'), ('airpressure', 'd'))
+
+    def __init__(self):
+        self.timestamps = array.array('l')
+        self.values = dict((name, array.array(typecode))
+                           for name, typecode in self.FIELDS)
+        self.valid = dict((name, array.array('B'))
+                          for name, typecode in self.FIELDS)
+
+    def add(self, timestamp, speed, watts=None, cadence=None,
+            heartrate=None, temperature=None, airpressure=None):
+        """Add a point. Values that are not available are None."""
+
+        self.timestamps.append(timestamp)
+
+        values = self.values
+        valid = self.valid
+
+        for (name, typecode), value in zip(self.FIELDS, (
+                speed, watts, cadence, heartrate, temperature, airpressure)):
+            values[name].append(value or 0)
+            valid[name].append(value is not None)
+
+    def __getstate__(self):
+
+        state = _Columns.__getstate__(self)
+
+        for name in ('values', 'valid'):
+            state[name] = dict((key, _pack_array(a))
+                               for key, a in state[name].iteritems())
+        return state
+
+    def __setstate__(self, state):
+
+        state = state.copy()
+
+        for name in ('values', 'valid'):
+            state[name] = dict((key, _unpack_array(packed))
+                               for key, packed in state[name].iteritems())
+
+        _Columns.__setstate__(self, state)
+
+    def extend_arrays(self, timestamps, values, valid):
+        """
+        Add points from arrays. values and valid are dicts of arrays
+        keyed by the value names. Values missing from the dicts are
+        not available.
+        """
+
+        count = len(timestamps)
+
+        self.timestamps.extend(timestamps)
+
+        for name, typecode in self.FIELDS:
+            if name in values:
+                self.values[name].extend(values[name])
+                self.valid[name].extend(valid[name])
+            else:
+                self.values[name].extend(array.array(typecode, [0]) * count)
+                self.valid[name].extend(array.array('B', [0]) * count)
+
+
+
+class BlockCache(object):
+    """
+    A bounded LRU cache of device blocks.
+
+    The hits and misses are counted to make it possible to see how
+    many reads the cache saved.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __contains__(self, block_nr):
+        return block_nr in self.blocks
+
+    def get(self, block_nr):
+
+        data = self.blocks.pop(block_nr, None)
+
+        if data is None:
+            self.misses += 1
+            return None
+
+        # Move it to the end so it becomes the most recently used.
+        self.blocks[block_nr] = data
+        self.hits += 1
+
+        return data
+
+    def put(self, block_nr, data):
+
+        self.blocks.pop(block_nr, None)
+        self.blocks[block_nr] = data
+
+        if len(self.blocks) > self.size:
+            self.blocks.popitem(last=False)
+
+    def clear(self):
+        self.blocks.clear()
+
+
+
+_INT32 = struct.Struct('<i')
+_UINT32 = struct.Struct('<I')
+_INT16 = struct.Struct('<h')
+_UINT16 = struct.Struct('<H')
+_INT8 = struct.Struct('<b')
+_UINT8 = struct.Struct('<B')
+
+
+
 class DataBuffer(object):
+    """
+    Gives access to the data on the device from a position.
+
+    The blocks that have been read are kept in a page table
+    keyed by the block number. Values are unpacked directly from
+    the blocks without copying the data.
+    """
 
-    def __init__(self, device, data, rel_offset=0, abs_offset=0,
-                 data_len=None):
+    # Maximum number of blocks to read ahead when the data
+    # is read sequentially.
+    MAX_READ_AHEAD = 8
+
+    def __init__(self, device, pages, rel_offset=0, abs_offset=0):
         self.device = device
-        self.data = data
+        self.block_size = device.BLOCK_SIZE
+        self.pages = pages
         self.rel_offset = rel_offset
         self.abs_offset = abs_offset
-        self.data_len = data_len or self.device.BLOCK_SIZE
+        self.read_ahead = 1
+        self._next_block = None
 
     @property
     def abs_position(self):
@@ -83,52 +454,116 @@ class DataBuffer(object):
 
     def buffer_from(self, offset):
 
-        return DataBuffer(self.device, self.data, self.rel_offset + offset,
-                          self.abs_offset, self.data_len)
+        return DataBuffer(self.device, self.pages, self.rel_offset + offset,
+                          self.abs_offset)
 
     def set_offset(self, offset):
         self.rel_offset += offset
 
+    def prefetch(self, length):
+        """Make sure the next length bytes are read from the device."""
+
+        block_size = self.block_size
+
+        first = self.abs_position / block_size
+        last = (self.abs_position + length - 1) / block_size
+
+        missing = [nr for nr in range(first, last + 1)
+                   if nr not in self.pages]
+
+        if missing:
+            self._read_pages(missing[0], missing[-1] - missing[0] + 1)
+
     def read_from(self, offset, length):
 
-        start_offset = self.rel_offset + offset
-        end_offset = start_offset + length - 1
+        block_size = self.block_size
+
+        pos = self.abs_position + offset
+        end = pos + length
+
+        parts = []
+        while pos < end:
+
+            block_nr, page_offset = divmod(pos, block_size)
 
-        if end_offset >= self.data_len:
+            n = min(end - pos, block_size - page_offset)
 
-            blocks = end_offset / self.device.BLOCK_SIZE
+            parts.append(str(buffer(self._page(block_nr), page_offset, n)))
 
-            for b in range(blocks):
+            pos += n
 
-                abs_offset = self.abs_offset + end_offset + \
-                    b * self.device.BLOCK_SIZE
+        return ''.join(parts)
 
-                block_addr = self.device.offset_to_block(abs_offset)
-                self.data.extend(self.device.read_block(block_addr))
-                self.data_len += self.device.BLOCK_SIZE
+    def unpack_from(self, s, offset):
+        """Unpack the struct.Struct s from offset."""
 
-        return self.data[start_offset:start_offset + length]
+        pos = self.abs_offset + self.rel_offset + offset
+        block_size = self.block_size
+        block_nr = pos / block_size
+        page_offset = pos - block_nr * block_size
+
+        if page_offset + s.size > block_size:
+            # The value is split between two blocks.
+            return s.unpack(self.read_from(offset, s.size))
+
+        page = self.pages.get(block_nr)
+        if page is None:
+            page = self._page(block_nr)
+
+        return s.unpack_from(page, page_offset)
+
+    def _page(self, block_nr):
+
+        page = self.pages.get(block_nr)
+
+        if page is None:
+
+            if block_nr == self._next_block:
+                # The data is read sequentially, so read more
+                # the next time.
+                self.read_ahead = min(self.read_ahead * 2,
+                                      self.MAX_READ_AHEAD)
+            else:
+                self.read_ahead = 1
+
+            count = min(self.read_ahead,
+                        self.device.BLOCK_COUNT - block_nr + 1)
+
+            # Only read the pages that are missing.
+            while count > 1 and block_nr + count - 1 in self.pages:
+                count -= 1
+
+            self._read_pages(block_nr, count)
+
+            page = self.pages[block_nr]
+
+        return page
+
+    def _read_pages(self, block_nr, count):
+
+        for i, block in enumerate(self.device.read_blocks(block_nr, count)):
+            self.pages[block_nr + i] = block
+
+        self._next_block = block_nr + count
 
 
     def int32_from(self, offset):
-        return struct.unpack('i', self.read_from(offset, 4))[0]
+        return self.unpack_from(_INT32, offset)[0]
 
     def uint32_from(self, offset):
-        return struct.unpack('I', self.read_from(offset, 4))[0]
+        return self.unpack_from(_UINT32, offset)[0]
 
     def int16_from(self, offset):
-        return struct.unpack('h', self.read_from(offset, 2))[0]
+        return self.unpack_from(_INT16, offset)[0]
 
     def uint16_from(self, offset):
-        return struct.unpack('H', self.read_from(offset, 2))[0]
+        return self.unpack_from(_UINT16, offset)[0]
 
     def int8_from(self, offset):
-        return struct.unpack('b', self.read_from(offset, 1))[0]
+        return self.unpack_from(_INT8, offset)[0]
 
     def uint8_from(self, offset):
-        return struct.unpack('B', self.read_from(offset, 1))[0]
+        return self.unpack_from(_UINT8, offset)[0]
 
     def str_from(self, offset, length):
-        return self.read_from(offset, length).tostring()
-
-
+        return self.read_from(offset, length)
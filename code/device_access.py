@@ -20,15 +20,17 @@
 import struct
 import array
 import errno
-import sys
+import mmap
+import os
 
-from common import print_msg
+import image_file
+import block_store
 
 try:
     import py_sg
-except ImportError, e:
-    print_msg('You need to install the "py_sg" module.')
-    sys.exit(1)
+    has_py_sg = True
+except ImportError:
+    has_py_sg = False
 
 
 
@@ -62,8 +64,13 @@ class DeviceAccess(object):
 
     BLOCK_SIZE = 512
 
+    is_image = False
+
     def __init__(self, dev_path):
 
+        if not has_py_sg:
+            raise RuntimeError('You need to install the "py_sg" module.')
+
         self.dev_path = dev_path
         self.dev = None
 
@@ -90,8 +97,117 @@ class DeviceAccess(object):
 
         cdb = _scsi_read10(addr, block_count, reserved_byte=read_type)
 
-        data = py_sg.read(self.dev, cdb, self.BLOCK_SIZE * block_count)
+        try:
+            data = py_sg.read(self.dev, cdb, self.BLOCK_SIZE * block_count)
+        except py_sg.SCSIError as e:
+            raise IOError('SCSI read failed: {0}'.format(e))
 
         return array.array('B', data)
 
 
+
+class ImageAccess(object):
+    """
+    Serves read_addr() from a raw image, a sparse image or a block store
+    manifest created by dump.py instead of sending SCSI commands to the
+    device.
+
+    Raw images are memory mapped and the data is returned as read-only
+    buffer views into the mapping, so no data is copied until it is used.
+    Sparse images and manifests only load the blocks that are read.
+    """
+
+    BLOCK_SIZE = 512
+
+    # Addresses of data reads are in units of 4096 bytes, which is
+    # the size of the blocks written by dump.py.
+    ADDR_SIZE = 4096
+
+    READ_DATA = 0x10
+    READ_SERIAL = 0x03
+
+    is_image = True
+
+    def __init__(self, image_path, serial=None):
+
+        self.image_path = image_path
+        self.serial = serial
+        self.image = None
+        self.map = None
+        self.reader = None
+
+
+    def open(self):
+
+        try:
+            self.image = open(self.image_path, 'rb')
+        except IOError as e:
+            if e.errno == errno.EACCES:
+                raise RuntimeError('Failed to open image "{0}" '
+                                   '(Permission denied).'.format(
+                                   self.image_path))
+            raise
+
+        if os.fstat(self.image.fileno()).st_size == 0:
+            self.image.close()
+            self.image = None
+            raise RuntimeError('Image "{0}" is empty.'.format(
+                               self.image_path))
+
+        if image_file.is_sparse_image(self.image):
+            reader = image_file.SparseImage
+        elif block_store.is_manifest(self.image):
+            reader = block_store.ManifestImage
+        else:
+            reader = None
+
+        if reader is not None:
+            try:
+                self.reader = reader(self.image)
+            except RuntimeError as e:
+                self.image.close()
+                self.image = None
+                raise RuntimeError('Image "{0}": {1}'.format(
+                                   self.image_path, e))
+            if self.serial is None:
+                self.serial = self.reader.serial
+            return
+
+        self.map = mmap.mmap(self.image.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        else:
+            self.map.close()
+            self.map = None
+        self.image.close()
+        self.image = None
+
+
+    def read_addr(self, addr, block_count=8, read_type=0):
+
+        length = self.BLOCK_SIZE * block_count
+
+        if read_type == self.READ_SERIAL:
+            # The device returns empty data with the serial at the end.
+            serial = (self.serial or '').ljust(16, '\0')[:16]
+            return buffer('\0' * (length - 16) + serial)
+
+        if read_type != self.READ_DATA:
+            raise IOError('Read type {0:#x} is not available '
+                          'in images.'.format(read_type))
+
+        offset = addr * self.ADDR_SIZE
+
+        if self.reader is not None:
+            if offset + length > len(self.reader):
+                raise IOError('Reading past end of image.')
+            return buffer(self.reader.read(offset, length))
+
+        if offset + length > len(self.map):
+            raise IOError('Reading past end of image.')
+
+        return buffer(self.map, offset, length)
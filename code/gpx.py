@@ -19,9 +19,9 @@
 
 import datetime
 
-from xml.etree import cElementTree as xml
+import cStringIO as StringIO
 
-from utils import indent_element_tree
+from utils import XmlWriter, export_track
 
 
 _GPX_NS = "http://www.topografix.com/GPX/1/1"
@@ -36,72 +36,107 @@ _TPX_NS_XSD = "http://www.garmin.com/xmlschemas/TrackPointExtensionv1.xsd"
 _from_ts = datetime.datetime.utcfromtimestamp
 
 
-def _ns(name, ns):
-    return '{{{0}}}{1}'.format(ns, name)
+def _format_timestamp(ts):
+    return _from_ts(ts).strftime('%Y-%m-%dT%H:%M:%SZ')
 
 
-def gpx_ns(name):
-    return _ns(name, _GPX_NS)
+# The date part of the timestamps is cached for each day, the time
+# part is looked up in the tables.
+_day_prefixes = {}
+_MINUTES = ['{0:02d}:{1:02d}:'.format(*divmod(m, 60)) for m in xrange(1440)]
+_SECONDS = ['{0:02d}Z'.format(s) for s in xrange(60)]
 
 
-def xsi_ns(name):
-    return _ns(name, _XSI_NS)
+def _day_prefix(day):
 
+    prefix = _day_prefixes.get(day)
+    if prefix is None:
+        if len(_day_prefixes) >= 1024:
+            _day_prefixes.clear()
+        prefix = _from_ts(day * 86400).strftime('%Y-%m-%dT')
+        _day_prefixes[day] = prefix
+    return prefix
 
-def gpxx_ns(name):
-    return _ns(name, _GPXX_NS)
 
+def format_timestamp(ts):
 
-def tpx_ns(name):
-    return _ns(name, _TPX_NS)
+    if not isinstance(ts, (int, long)):
+        return _format_timestamp(ts)
 
+    day, secs = divmod(ts, 86400)
+    minute, sec = divmod(secs, 60)
+
+    return _day_prefix(day) + _MINUTES[minute] + _SECONDS[sec]
 
-def format_timestamp(ts):
-    return _from_ts(ts).strftime('%Y-%m-%dT%H:%M:%SZ')
 
+def format_timestamps(timestamps):
+    """Formats a sequence of timestamps, like a timestamp column."""
 
-def create_trkpt(trkpt, parent, ns=gpx_ns):
+    minutes = _MINUTES
+    seconds = _SECONDS
+
+    out = []
+    append = out.append
+
+    last_day = None
+    prefix = None
+
+    for ts in timestamps:
+
+        if not isinstance(ts, (int, long)):
+            append(_format_timestamp(ts))
+            continue
 
-    p = xml.SubElement(parent, ns('trkpt'))
+        day, secs = divmod(ts, 86400)
+        if day != last_day:
+            last_day = day
+            prefix = _day_prefix(day)
 
-    p.set(ns('lat'), format(trkpt.latitude, '.6f'))
-    p.set(ns('lon'), format(trkpt.longitude, '.6f'))
+        append(prefix + minutes[secs // 60] + seconds[secs % 60])
 
-    xml.SubElement(p, ns('ele')).text = format(trkpt.elevation, '.1f')
-    xml.SubElement(p, ns('time')).text = format_timestamp(trkpt.timestamp)
+    return out
 
-    return p
 
+def write_trkpt(w, trkpt):
 
-def create_trkseg(seg, parent, ns=gpx_ns):
+    w.start('trkpt', (('lat', format(trkpt.latitude, '.6f')),
+                      ('lon', format(trkpt.longitude, '.6f'))))
 
-    trkseg = xml.SubElement(parent, ns('trkseg'))
+    w.element('ele', format(trkpt.elevation, '.1f'))
+    w.element('time', format_timestamp(trkpt.timestamp))
+
+
+def write_trkseg(w, seg):
+
+    w.start('trkseg')
 
     for tp in seg:
-        create_trkpt(tp, trkseg, ns)
+        write_trkpt(w, tp)
+        w.end()
 
-    return trkseg
+    w.end()
 
 
-def create_tpx_trkseg(seg, parent, ns=gpx_ns):
+def write_tpx_trkseg(w, seg):
 
-    trkseg = xml.SubElement(parent, ns('trkseg'))
+    w.start('trkseg')
 
     for tp, lp in seg:
 
         if not tp:
             continue
 
-        trkpt = create_trkpt(tp, trkseg, ns)
+        write_trkpt(w, tp)
 
         if lp and has_values_for_tpx(lp):
 
-            ext = xml.SubElement(trkpt, ns('extensions'))
+            w.start('extensions')
+            write_tpx(w, lp)
+            w.end()
 
-            create_tpx(lp, ext)
+        w.end()
 
-
-    return trkseg
+    w.end()
 
 
 def has_values_for_tpx(lp):
@@ -110,75 +145,93 @@ def has_values_for_tpx(lp):
         lp.cadence is not None
 
 
-def create_tpx(tp, parent, ns=tpx_ns):
+def write_tpx(w, tp):
 
-    tpx = xml.SubElement(parent, ns('TrackPointExtension'))
+    w.start('gpxtpx:TrackPointExtension')
 
     if tp.temperature is not None:
-        xml.SubElement(tpx, ns('atemp')).text = format(tp.temperature, '.1f')
+        w.element('gpxtpx:atemp', format(tp.temperature, '.1f'))
 
     if tp.heartrate is not None:
-        xml.SubElement(tpx, ns('hr')).text = format(tp.heartrate, 'd')
+        w.element('gpxtpx:hr', format(tp.heartrate, 'd'))
 
     if tp.cadence is not None:
-        xml.SubElement(tpx, ns('cad')).text = format(tp.cadence, 'd')
+        w.element('gpxtpx:cad', format(tp.cadence, 'd'))
 
+    w.end()
 
-def track_to_plain_gpx(track, pretty=False):
 
-    ns = gpx_ns
+def _start_gpx(w, namespaces, schema_locations):
 
-    root = xml.Element(ns('gpx'))
+    w.declaration()
 
-    root.set(xsi_ns('schemaLocation'), ' '.join([_GPX_NS, _GPX_NS_XSD]))
+    w.start('gpx', [('xmlns', _GPX_NS)] + namespaces + [
+        ('xmlns:xsi', _XSI_NS),
+        ('creator', 'Bryton-GPS-Linux'),
+        ('version', '1.1'),
+        ('xsi:schemaLocation', ' '.join(schema_locations))])
 
-    root.set(ns('version'), '1.1')
-    root.set(ns('creator'), 'Bryton-GPS-Linux')
+    w.start('trk')
 
-    xml.register_namespace('', _GPX_NS)
 
-    trk = xml.SubElement(root, ns('trk'))
+class PlainGpxExporter(object):
 
-    for seg in track.trackpoints:
+    merged = False
 
-        if seg:
-            create_trkseg(seg, trk, ns)
+    def __init__(self, f, pretty=False):
+        self.w = XmlWriter(f, pretty)
 
+    def start(self, track):
+        _start_gpx(self.w, [], [_GPX_NS, _GPX_NS_XSD])
 
-    if pretty:
-        indent_element_tree(root, ws=' ')
+    def segment(self, tseg, lseg, merged):
+        if tseg:
+            write_trkseg(self.w, tseg)
 
-    return "<?xml version='1.0' encoding='utf-8'?>\n" + xml.tostring(root)
+    def finish(self):
+        self.w.end()
+        self.w.end()
 
 
-def track_to_garmin_gpxx(track, pretty=False):
 
-    ns = gpx_ns
+class GarminGpxxExporter(object):
+
+    merged = True
 
-    root = xml.Element(ns('gpx'))
+    def __init__(self, f, pretty=False):
+        self.w = XmlWriter(f, pretty)
 
-    root.set(xsi_ns('schemaLocation'), ' '.join([
-        _GPX_NS, _GPX_NS_XSD, _TPX_NS, _TPX_NS_XSD]))
+    def start(self, track):
+        _start_gpx(self.w, [('xmlns:gpxtpx', _TPX_NS)],
+                   [_GPX_NS, _GPX_NS_XSD, _TPX_NS, _TPX_NS_XSD])
 
-    root.set(ns('version'), '1.1')
-    root.set(ns('creator'), 'Bryton-GPS-Linux')
+    def segment(self, tseg, lseg, merged):
+        if tseg:
+            write_tpx_trkseg(self.w, merged)
 
-    xml.register_namespace('', _GPX_NS)
-    xml.register_namespace('gpxtpx', _TPX_NS)
+    def finish(self):
+        self.w.end()
+        self.w.end()
 
-    trk = xml.SubElement(root, ns('trk'))
 
-    for seg in track.merged_segments():
 
-        create_tpx_trkseg(seg, trk, ns)
+def write_plain_gpx(track, f, pretty=False):
+    export_track(track, [PlainGpxExporter(f, pretty)])
 
 
-    if pretty:
-        indent_element_tree(root, ws=' ')
+def write_garmin_gpxx(track, f, pretty=False):
+    export_track(track, [GarminGpxxExporter(f, pretty)])
 
-    return "<?xml version='1.0' encoding='utf-8'?>\n" + xml.tostring(root)
 
+def track_to_plain_gpx(track, pretty=False):
 
+    f = StringIO.StringIO()
+    write_plain_gpx(track, f, pretty)
+    return f.getvalue()
 
 
+def track_to_garmin_gpxx(track, pretty=False):
 
+    f = StringIO.StringIO()
+    write_garmin_gpxx(track, f, pretty)
+    return f.getvalue()
@@ -0,0 +1,240 @@
+#
+# Copyright (C) 2013  Per Myren
+#
+# This file is part of Bryton-GPS-Linux
+#
+# Bryton-GPS-Linux is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Bryton-GPS-Linux is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Bryton-GPS-Linux.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+A compact container for device images.
+
+The file starts with a header with the device serial, the model id
+and the current log entry, followed by an index with the offset and
+length of each block. Erased blocks (all 0xff) are left out and the
+other blocks are compressed one by one, so any block can be read
+without reading the rest of the image.
+"""
+
+import mmap
+import struct
+import zlib
+
+
+MAGIC = 'BRYTNIMG'
+VERSION = 1
+
+BLOCK_SIZE = 4096
+
+# The log is a list of 256 byte entries in the first 0x6000 bytes.
+# The space left, start offset and end offset of the history, laps,
+# workouts, workout logs, trackpoints and logpoints start at offset
+# 0x58 in the entry.
+LOG_SIZE = 0x6000
+LOG_ENTRY_SIZE = 256
+_LOG_ENTRY = struct.Struct('<18I')
+
+# magic, version, block size, block count, serial, model, log entry
+_HEADER = struct.Struct('<8sHxxII16s4s72s')
+
+# The offset and length of a block. The length is 0 for erased blocks
+# and BLOCK_SIZE for blocks that are stored uncompressed.
+_INDEX_ENTRY = struct.Struct('<QI')
+
+ERASED_BLOCK = '\xff' * BLOCK_SIZE
+
+
+def last_log_entry(log):
+    """
+    Returns the last used log entry. Erased entries start with 0xffff,
+    the used entries may follow some erased entries.
+    """
+
+    used = [log[i:i + 2] != '\xff\xff'
+            for i in range(0, LOG_SIZE, LOG_ENTRY_SIZE)]
+
+    try:
+        last = used.index(False, used.index(True)) - 1
+    except ValueError:
+        # Either no entries are used, or the used entries
+        # continue to the end of the log.
+        last = len(used) - 1
+
+    return log[last * LOG_ENTRY_SIZE:(last + 1) * LOG_ENTRY_SIZE]
+
+
+def read_log_entry(log):
+    """Returns the values of the last used log entry."""
+    return _LOG_ENTRY.unpack_from(last_log_entry(log), 0x58)
+
+
+def has_magic(f, magic):
+    """Checks the start of the file object f without moving it."""
+
+    pos = f.tell()
+    data = f.read(len(magic))
+    f.seek(pos)
+
+    return data == magic
+
+
+def is_sparse_image(f):
+    return has_magic(f, MAGIC)
+
+
+def write_sparse_image(f, data, serial=''):
+    """Writes the raw image data to the file object f."""
+
+    count = len(data) // BLOCK_SIZE
+
+    model = ''
+    if data[6 * BLOCK_SIZE:].startswith('Hera Data'):
+        model = data[6 * BLOCK_SIZE + 16:6 * BLOCK_SIZE + 20]
+
+    log_entry = _LOG_ENTRY.pack(*read_log_entry(data[:LOG_SIZE]))
+
+    f.write(_HEADER.pack(MAGIC, VERSION, BLOCK_SIZE, count, serial, model,
+                         log_entry))
+
+    index_offset = f.tell()
+    f.write('\0' * (_INDEX_ENTRY.size * count))
+
+    index = []
+
+    for nr in xrange(count):
+
+        block = data[nr * BLOCK_SIZE:(nr + 1) * BLOCK_SIZE]
+
+        if block == ERASED_BLOCK:
+            index.append(_INDEX_ENTRY.pack(0, 0))
+            continue
+
+        compressed = zlib.compress(block, 9)
+        if len(compressed) < BLOCK_SIZE:
+            block = compressed
+
+        index.append(_INDEX_ENTRY.pack(f.tell(), len(block)))
+        f.write(block)
+
+    f.seek(index_offset)
+    f.write(''.join(index))
+    f.seek(0, 2)
+
+
+def read_image(path):
+    """
+    Returns (data, serial) for a raw image or a sparse image. The
+    serial is empty for raw images.
+    """
+
+    with open(path, 'rb') as f:
+
+        if not is_sparse_image(f):
+            return f.read(), ''
+
+        image = SparseImage(f)
+        try:
+            return image.read(0, len(image)), image.serial
+        finally:
+            image.close()
+
+
+
+class BlockImage(object):
+    """
+    An image that is stored one block at a time. Only the blocks that
+    are read are loaded. Subclasses implement block() and set the
+    block count.
+    """
+
+    block_size = BLOCK_SIZE
+    block_count = 0
+
+    serial = ''
+
+    def __len__(self):
+        return self.block_size * self.block_count
+
+    def close(self):
+        pass
+
+    def block(self, nr):
+        """Returns the data of block nr."""
+
+    def read(self, offset, length):
+
+        first = offset // self.block_size
+        last = (offset + length - 1) // self.block_size
+
+        data = ''.join(self.block(nr) for nr in xrange(first, last + 1))
+
+        start = offset - first * self.block_size
+        return data[start:start + length]
+
+
+
+class SparseImage(BlockImage):
+    """
+    A sparse image in a file object. The file is memory mapped and
+    the blocks are found with the index after the header.
+    """
+
+    def __init__(self, f):
+
+        self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.map) < _HEADER.size:
+            raise RuntimeError('Invalid image.')
+
+        (magic, version, self.block_size, self.block_count, serial,
+         self.model, log_entry) = _HEADER.unpack_from(self.map, 0)
+
+        if magic != MAGIC:
+            raise RuntimeError('Invalid image.')
+        if version != VERSION:
+            raise RuntimeError('Unsupported image version {0}.'.format(
+                version))
+
+        if len(self.map) < _HEADER.size + \
+                self.block_count * _INDEX_ENTRY.size:
+            raise RuntimeError('Invalid image.')
+
+        self.serial = serial.rstrip('\0')
+        self.log_entry = _LOG_ENTRY.unpack(log_entry)
+
+    def close(self):
+        self.map.close()
+
+    def block(self, nr):
+
+        if not 0 <= nr < self.block_count:
+            raise IOError('Block {0} is not in the image.'.format(nr))
+
+        offset, length = _INDEX_ENTRY.unpack_from(
+            self.map, _HEADER.size + nr * _INDEX_ENTRY.size)
+
+        if length == 0:
+            return ERASED_BLOCK
+
+        if offset + length > len(self.map):
+            raise IOError('Block {0} is truncated.'.format(nr))
+
+        if length == self.block_size:
+            return self.map[offset:offset + length]
+
+        try:
+            return zlib.decompress(self.map[offset:offset + length])
+        except zlib.error as e:
+            raise IOError('Block {0} is corrupt ({1}).'.format(nr, e))
@@ -18,10 +18,12 @@
 #
 
 import json
+import cStringIO as StringIO
 
 from collections import OrderedDict
 
-from gpx import format_timestamp
+from utils import export_track
+from gpx import format_timestamp, format_timestamps
 
 
 
@@ -54,66 +56,216 @@ def _create_summary(sum):
     return d
 
 
-def track_to_json(track, pretty=False):
+class _JsonWriter(object):
+    """
+    Writes JSON a piece at a time with the same layout as json.dumps
+    and json.dumps(indent=1, separators=(',', ': ')) when pretty.
+    """
 
-    out = OrderedDict()
+    def __init__(self, f, pretty=False):
+        self.f = f
+        self.pretty = pretty
+        if pretty:
+            self.encoder = json.JSONEncoder(indent=1, separators=(',', ': '))
+        else:
+            self.encoder = json.JSONEncoder()
+        # The number of items written to each open object or array.
+        self.counts = []
 
-    out['name'] = track.name
-    out['timestamp'] = format_timestamp(track.timestamp)
+    def _item(self, key):
 
-    trackpoints = []
-    for seg in track.trackpoints:
-        segment = []
-        for tp in seg:
-            segment.append(OrderedDict((
-                ('timestamp', format_timestamp(tp.timestamp)),
-                ('latitude', tp.latitude),
-                ('longitude', tp.longitude),
-                ('elevation', tp.elevation),
-            )))
-        trackpoints.append(segment)
-    out['trackpoints'] = trackpoints
+        counts = self.counts
+        if not counts:
+            return
 
+        if counts[-1]:
+            self.f.write(self.encoder.item_separator)
+        counts[-1] += 1
 
-    logpoints = []
-    for seg in track.logpoints:
-        segment = []
-        for lp in seg:
-            d = OrderedDict((
-                ('timestamp', format_timestamp(lp.timestamp)),
-            ))
-            if lp.speed is not None:
-                d['speed'] = lp.speed
-            if lp.temperature is not None:
-                d['temperature'] = lp.temperature
-            if lp.airpressure is not None:
-                d['airpressure'] = lp.airpressure
-            if lp.cadence is not None:
-                d['cadence'] = lp.cadence
-            if lp.heartrate is not None:
-                d['heartrate'] = lp.heartrate
-            if lp.watts is not None:
-                d['watts'] = lp.watts
+        if self.pretty:
+            self.f.write('\n' + ' ' * len(counts))
 
-            segment.append(d)
+        if key is not None:
+            self.f.write(self.encoder.encode(key) + self.encoder.key_separator)
 
-        logpoints.append(segment)
-    out['logpoints'] = logpoints
+    def start_object(self, key=None):
+        self._item(key)
+        self.f.write('{')
+        self.counts.append(0)
 
+    def start_array(self, key=None):
+        self._item(key)
+        self.f.write('[')
+        self.counts.append(0)
 
-    laps = []
-    if track.lap_count > 0:
-        for sum in track.lap_summaries:
-            laps.append(_create_summary(sum))
-    out['laps'] = laps
+    def end_object(self):
+        self._end('}')
 
-    out['summary'] = _create_summary(track.summary)
+    def end_array(self):
+        self._end(']')
 
+    def _end(self, bracket):
 
+        count = self.counts.pop()
+        if self.pretty and count:
+            self.f.write('\n' + ' ' * len(self.counts))
+        self.f.write(bracket)
 
-    if pretty:
-        return json.dumps(out, indent=1, separators=(',', ': '))
+    def value(self, obj, key=None):
 
-    return json.dumps(out)
+        self._item(key)
 
+        data = self.encoder.encode(obj)
+        if self.pretty and self.counts:
+            data = data.replace('\n', '\n' + ' ' * len(self.counts))
+        self.f.write(data)
 
+
+
+def _write_points(w, seg, create_point):
+
+    w.start_array()
+    for p in seg:
+        w.value(create_point(p))
+    w.end_array()
+
+
+def _create_trackpoint(tp):
+
+    return OrderedDict((
+        ('timestamp', format_timestamp(tp.timestamp)),
+        ('latitude', tp.latitude),
+        ('longitude', tp.longitude),
+        ('elevation', tp.elevation),
+    ))
+
+
+def _create_logpoint(lp):
+
+    d = OrderedDict((
+        ('timestamp', format_timestamp(lp.timestamp)),
+    ))
+    if lp.speed is not None:
+        d['speed'] = lp.speed
+    if lp.temperature is not None:
+        d['temperature'] = lp.temperature
+    if lp.airpressure is not None:
+        d['airpressure'] = lp.airpressure
+    if lp.cadence is not None:
+        d['cadence'] = lp.cadence
+    if lp.heartrate is not None:
+        d['heartrate'] = lp.heartrate
+    if lp.watts is not None:
+        d['watts'] = lp.watts
+
+    return d
+
+
+# The logpoint values in the order they are written.
+_LOGPOINT_FIELDS = ('speed', 'temperature', 'airpressure', 'cadence',
+                    'heartrate', 'watts')
+
+
+def _write_trackpoint_columns(w, seg):
+
+    w.start_object()
+    w.value(format_timestamps(seg.timestamps), 'timestamp')
+    w.value([v / 1000000.0 for v in seg.latitudes], 'latitude')
+    w.value([v / 1000000.0 for v in seg.longitudes], 'longitude')
+    w.value(seg.elevation_list(), 'elevation')
+    w.end_object()
+
+
+def _write_logpoint_columns(w, seg):
+    """
+    Values that are not available are null, values that are not
+    available for any of the points in a segment are left out.
+    The speed is 0 when it's not available, like for LogPoint.
+    """
+
+    w.start_object()
+    w.value(format_timestamps(seg.timestamps), 'timestamp')
+    for name in _LOGPOINT_FIELDS:
+        values = seg.values[name]
+        valid = seg.valid[name]
+        if name == 'speed' or all(valid):
+            w.value(values.tolist(), name)
+        elif any(valid):
+            w.value([v if ok else None for v, ok in zip(values, valid)],
+                    name)
+    w.end_object()
+
+
+
+class JsonExporter(object):
+    """
+    Writes the track as JSON, one point at a time. With columnar
+    each segment is an object with an array for each value instead
+    of an array of points.
+    """
+
+    merged = False
+
+    def __init__(self, f, pretty=False, columnar=False):
+        self.w = _JsonWriter(f, pretty)
+        self.columnar = columnar
+
+    def start(self, track):
+
+        w = self.w
+
+        self.track = track
+        # The logpoints come after all the trackpoints.
+        self.logpoints = []
+
+        w.start_object()
+
+        w.value(track.name, 'name')
+        w.value(format_timestamp(track.timestamp), 'timestamp')
+
+        w.start_array('trackpoints')
+
+    def segment(self, tseg, lseg, merged):
+
+        if self.columnar:
+            _write_trackpoint_columns(self.w, tseg)
+        else:
+            _write_points(self.w, tseg, _create_trackpoint)
+
+        self.logpoints.append(lseg)
+
+    def finish(self):
+
+        w = self.w
+        track = self.track
+
+        w.end_array()
+
+        w.start_array('logpoints')
+        for lseg in self.logpoints:
+            if self.columnar:
+                _write_logpoint_columns(w, lseg)
+            else:
+                _write_points(w, lseg, _create_logpoint)
+        w.end_array()
+
+        laps = []
+        if track.lap_count > 0:
+            for sum in track.lap_summaries:
+                laps.append(_create_summary(sum))
+        w.value(laps, 'laps')
+
+        w.value(_create_summary(track.summary), 'summary')
+
+        w.end_object()
+
+
+def write_json(track, f, pretty=False, columnar=False):
+    export_track(track, [JsonExporter(f, pretty, columnar)])
+
+
+def track_to_json(track, pretty=False, columnar=False):
+
+    f = StringIO.StringIO()
+    write_json(track, f, pretty, columnar)
+    return f.getvalue()
@@ -19,9 +19,26 @@
 
 import warnings
 import itertools
+import bisect
+import json
+import os
+import struct
+import array
 
-from utils import cached_property
-from common import DataBuffer, TrackPoint, LogPoint, AvgMax
+from collections import namedtuple, deque
+from functools import partial
+
+try:
+    import numpy as np
+    has_numpy = True
+except ImportError:
+    has_numpy = False
+
+from utils import cached_property, config_path
+from track_cache import TrackCache
+from image_file import LOG_SIZE, read_log_entry
+from common import DataBuffer, BlockCache, AvgMax, TrackPointColumns, \
+    LogPointColumns
 
 
 SEGMENT_BEFORE_MOVING = 0
@@ -39,25 +56,208 @@ class Rider40(object):
     BLOCK_SIZE = 4096
     BLOCK_COUNT = 0x1ff
 
+    # Big enough to keep every block on the device, so no block
+    # has to be read more than once.
+    BLOCK_CACHE_SIZE = BLOCK_COUNT + 1
+
+    # The largest number of blocks to try to read with one command.
+    MAX_TRANSFER_BLOCKS = 32
+
     has_altimeter = True
 
     def __init__(self, device_access):
         self.dev = device_access
+        self.cache = BlockCache(self.BLOCK_CACHE_SIZE)
 
 
     def read_serial(self):
 
         data = self.dev.read_addr(0, block_count=4, read_type=self.READ_SERIAL)
 
-        return data[-16:].tostring()
+        return buffer(data)[-16:]
 
 
     def read_block(self, block_nr):
 
-        if block_nr > self.BLOCK_COUNT:
+        return self.read_blocks(block_nr, 1)[0]
+
+
+    def read_blocks(self, block_nr, count):
+        """
+        Returns a list of the blocks from block_nr to block_nr + count.
+
+        Blocks that are not in the cache are read with as few commands
+        as possible, adjacent blocks are read with the same command.
+        If the device refuses a read, the transfer size is halved and
+        the read is tried again.
+        """
+
+        if block_nr + count - 1 > self.BLOCK_COUNT:
             raise IOError('Reading past end of device.')
 
-        return self.dev.read_addr(block_nr, 8, read_type=self.READ_DATA)
+        blocks = [self.cache.get(nr) for nr in range(block_nr,
+                                                     block_nr + count)]
+
+        i = 0
+        while i < count:
+
+            if blocks[i] is not None:
+                i += 1
+                continue
+
+            end = i + 1
+            while end < count and blocks[end] is None and \
+                    end - i < self.transfer_blocks:
+                end += 1
+
+            try:
+                data = self.dev.read_addr(block_nr + i, 8 * (end - i),
+                                          read_type=self.READ_DATA)
+            except EnvironmentError:
+                if end - i == 1:
+                    raise
+                data = None
+
+            if data is None or len(data) != (end - i) * self.BLOCK_SIZE:
+                if end - i == 1:
+                    raise IOError('Short read from device.')
+                self._lower_transfer_blocks(end - i)
+                continue
+
+            blocks[i:end] = self._cache_blocks(block_nr + i, end - i, data)
+            i = end
+
+        return blocks
+
+
+    @cached_property
+    def transfer_blocks(self):
+        """
+        The largest number of blocks the device will return for
+        one read command. It's probed the first time a device is used
+        and then remembered for the device serial. Images accept any
+        size, so they are neither probed nor remembered.
+        """
+
+        if self.dev.is_image:
+            return self.MAX_TRANSFER_BLOCKS
+
+        key = self._transfer_blocks_key
+
+        count = self._load_transfer_blocks().get(key) if key else None
+
+        if count is None:
+            count = self._probe_transfer_blocks()
+            if key:
+                self._save_transfer_blocks(key, count)
+
+        return count
+
+
+    @property
+    def _transfer_blocks_key(self):
+
+        serial = self.read_serial()
+        if not serial.strip('\0'):
+            # No point in remembering the value without a serial.
+            return None
+
+        return serial.encode('hex')
+
+
+    def _load_transfer_blocks(self):
+
+        try:
+            with open(config_path('transfer_blocks.json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+
+    def _save_transfer_blocks(self, key, count):
+
+        path = config_path('transfer_blocks.json')
+
+        sizes = self._load_transfer_blocks()
+        sizes[key] = count
+
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                json.dump(sizes, f)
+        except (IOError, OSError):
+            pass
+
+
+    def _lower_transfer_blocks(self, refused):
+        """
+        Halves the transfer size until it's below the refused number
+        of blocks, and remembers the new size for the device.
+        """
+
+        count = self.transfer_blocks // 2
+        while count >= refused:
+            count //= 2
+
+        self.transfer_blocks = count
+
+        key = self._transfer_blocks_key
+        if key and not self.dev.is_image:
+            self._save_transfer_blocks(key, count)
+
+
+    @cached_property
+    def track_cache(self):
+        """
+        The cache of decoded tracks for the device serial. None for
+        images, an image may have the serial of a device but it must
+        not change the state kept for the device.
+        """
+
+        if self.dev.is_image:
+            return None
+
+        serial = self.read_serial()
+        if not serial.strip('\0'):
+            return None
+
+        return TrackCache(serial.encode('hex'))
+
+
+    def _probe_transfer_blocks(self):
+
+        count = self.MAX_TRANSFER_BLOCKS
+
+        while count > 1:
+
+            try:
+                data = self.dev.read_addr(0, 8 * count,
+                                          read_type=self.READ_DATA)
+            except EnvironmentError:
+                data = None
+
+            if data is not None and len(data) == count * self.BLOCK_SIZE:
+                # The data is valid so we might as well keep it.
+                self._cache_blocks(0, count, data)
+                break
+
+            count /= 2
+
+        return count
+
+
+    def _cache_blocks(self, block_nr, count, data):
+
+        blocks = []
+        for i in range(count):
+
+            block = buffer(data, i * self.BLOCK_SIZE, self.BLOCK_SIZE)
+
+            self.cache.put(block_nr + i, block)
+            blocks.append(block)
+
+        return blocks
 
 
     def offset_to_block(self, offset):
@@ -66,13 +266,11 @@ class Rider40(object):
 
     def read_from_offset(self, offset):
 
-        d = self.read_block(self.offset_to_block(offset))
-
         rel_offset = offset % self.BLOCK_SIZE
 
         abs_offset = offset - rel_offset
 
-        return DataBuffer(self, d, rel_offset, abs_offset)
+        return DataBuffer(self, {}, rel_offset, abs_offset)
 
 
 
@@ -112,44 +310,26 @@ class Rider40(object):
     def last_log_entry(self):
 
         buf = self.read_from_offset(0)
-        found_first = False
 
-        for i in range(0x6000/256):
+        # Read the whole log with one command and scan it in memory.
+        buf.prefetch(LOG_SIZE)
 
+        return LogEntry._make(read_log_entry(buf.read_from(0, LOG_SIZE)))
 
-            if not found_first and buf.uint16_from(0) != 0xffff:
-                found_first = True
-            elif found_first and buf.uint16_from(0) == 0xffff:
-                break
-
-            buf.set_offset(256)
 
 
-        buf.set_offset(-256)
 
-        return _read_log_entry(buf)
 
-
-
-
-
-class LogEntry(object):
-
-    space_left_history = None
-    offset_start_history = None
-    offset_end_history = None
-
-    space_left_laps = None
-    offset_start_laps = None
-    offset_end_laps = None
-
-    space_left_trackpoints = None
-    offset_start_trackpoints = None
-    offset_end_trackpoints = None
-
-    space_left_logpoints = None
-    offset_start_logpoints = None
-    offset_end_logpoints = None
+LogEntry = namedtuple('LogEntry', [
+    'space_left_history', 'offset_start_history', 'offset_end_history',
+    'space_left_laps', 'offset_start_laps', 'offset_end_laps',
+    'space_left_workouts', 'offset_start_workouts', 'offset_end_workouts',
+    'space_left_workout_logs', 'offset_start_workout_logs',
+    'offset_end_workout_logs',
+    'space_left_trackpoints', 'offset_start_trackpoints',
+    'offset_end_trackpoints',
+    'space_left_logpoints', 'offset_start_logpoints', 'offset_end_logpoints',
+])
 
 
 
@@ -165,51 +345,187 @@ class Track(object):
     _offset_summary = None
     _offset_laps = None
 
+    # The timestamp in the history, it's not changed by time adjustments.
+    _history_timestamp = None
+
+    _segment_index = None
+
+    # Only the points between (start, end) are read when set, either
+    # can be None. It has to be set before the points are read.
+    time_window = None
+
 
     def __init__(self, device):
         self.device = device
 
 
+    @property
+    def key(self):
+        """Identifies the track on the device."""
+        return (self._history_timestamp, self._offset_trackpoints)
+
+
+    def read_all(self):
+        """Reads everything that is needed to export the track."""
+
+        self.trackpoints, self.logpoints
+        self.summary, self.lap_summaries
+
+
+    def __getstate__(self):
+        """
+        The device is left out when a track is pickled, so everything
+        that is needed to export it is read first.
+        """
+
+        self.read_all()
+
+        state = self.__dict__.copy()
+        del state['device']
+        for name in ('_segment_index', '_cached_points', '_points'):
+            state.pop(name, None)
+        return state
+
+
     @cached_property
-    def trackpoints(self):
+    def segment_index(self):
+        """
+        A list of (trackpoint SegmentInfo, logpoint SegmentInfo) for
+        each segment of the track.
+        """
+
+        index = self._load_cached('index')
+
+        if index is None:
+
+            if self._segment_index is None:
+                self._segment_index = SegmentIndex(self.device, [self])
+
+            index = self._segment_index.segments(self)
+            self._save_cached('index', index)
+
+        return index
+
+
+    def _load_cached(self, kind):
+
+        cache = self.device.track_cache
+        if cache is None:
+            return None
+
+        return cache.load(self.key, kind)
+
 
-        buf = self.device.read_from_offset(
-            self.device.last_log_entry.offset_start_trackpoints + \
-                                           self._offset_trackpoints)
+    def _save_cached(self, kind, entry):
 
-        return _read_trackpoint_segments(buf,
-                    self.device.last_log_entry.offset_start_trackpoints)
+        cache = self.device.track_cache
+        if cache is not None:
+            cache.save(self.key, kind, entry)
 
 
     @cached_property
-    def logpoints(self):
-        buf = None
-        segments = []
-        for tseg in self.trackpoints:
+    def _cached_points(self):
+        """
+        The (trackpoints, logpoints) of the whole track from the track
+        cache, None if they are not there.
+        """
+        return self._load_cached('points')
+
+
+    @cached_property
+    def _points(self):
+        """
+        The (trackpoints, logpoints) of the whole track. They are read
+        from the device and stored in the track cache if they are not
+        there.
+        """
 
-            offset = self.device.last_log_entry.offset_start_logpoints + \
-                    tseg._offset_logpoints
+        points = self._cached_points
 
+        if points is None:
+            points = (
+                _read_segments(self.device,
+                               [tp for tp, lp in self.segment_index],
+                               _read_trackpoint_segment),
+                _read_segments(self.device,
+                               [lp for tp, lp in self.segment_index],
+                               _read_logpoint_segment))
+            self._save_cached('points', points)
 
-            if buf is None:
-                buf = self.device.read_from_offset(offset)
-            elif buf.abs_offset + buf.rel_offset != offset:
-                warnings.warn('Unexpected logpoint offset.', RuntimeWarning)
-                buf = self.device.read_from_offset(offset)
+        return points
 
 
-            seg = _read_logpoint_segment(buf)
+    @cached_property
+    def _window_segments(self):
+        """The positions in segment_index that overlap time_window."""
+
+        if self.time_window is None:
+            return range(len(self.segment_index))
+
+        start, end = self.time_window
+
+        segments = []
 
-            #
-            #if seg.segment_type != tseg.segment_type:
-            #    raise RuntimeError('Matching segments are expected to have'
-            #                       ' the same type.')
+        index = self.segment_index
 
-            segments.append(seg)
+        for i, (tp, lp) in enumerate(index):
+
+            # The trackpoint segment ends when the next one starts.
+            ranges = []
+            if tp.count > 0:
+                next_start = index[i + 1][0].start if i + 1 < len(index) \
+                    else None
+                ranges.append((tp.start, next_start))
+            if lp.count > 0:
+                ranges.append((lp.start, lp.end))
+
+            for first, last in ranges:
+                if (end is None or first <= end) and \
+                        (start is None or last is None or last >= start):
+                    segments.append(i)
+                    break
 
         return segments
 
 
+    @cached_property
+    def trackpoints(self):
+
+        if self.time_window is None:
+            return self._points[0]
+
+        if self._cached_points is not None:
+            segments = [self._cached_points[0][i]
+                        for i in self._window_segments]
+        else:
+            segments = _read_segments(
+                self.device,
+                [self.segment_index[i][0] for i in self._window_segments],
+                _read_trackpoint_segment)
+
+        # The trackpoints are stored as differences from the previous
+        # point, so the whole segment has to be read.
+        return [_trackpoints_in_window(seg, *self.time_window)
+                for seg in segments]
+
+
+    @cached_property
+    def logpoints(self):
+
+        if self.time_window is None:
+            return self._points[1]
+
+        if self._cached_points is not None:
+            return [_logpoints_in_window(self._cached_points[1][i],
+                                         *self.time_window)
+                    for i in self._window_segments]
+
+        return _read_segments(
+            self.device,
+            [self.segment_index[i][1] for i in self._window_segments],
+            partial(_read_logpoint_segment, window=self.time_window))
+
+
     @cached_property
     def summary(self):
         return self._read_summaries[0]
@@ -228,6 +544,20 @@ class Track(object):
         pass
 
 
+    def segments(self, merge=True):
+        """
+        Yields (trackpoints, logpoints, merged) for each segment,
+        merged is a list of the merged points or None if merge is false.
+        """
+
+        for tseg, lseg in zip(self.trackpoints, self.logpoints):
+
+            if merge:
+                yield tseg, lseg, list(_merge_segments(tseg, lseg))
+            else:
+                yield tseg, lseg, None
+
+
     def merged_segments(self, remove_empty_track_segs=True):
 
         for tseg, lseg in zip(self.trackpoints, self.logpoints):
@@ -240,6 +570,17 @@ class Track(object):
     @cached_property
     def _read_summaries(self):
 
+        summaries = self._load_cached('summaries')
+
+        if summaries is None:
+            summaries = self._read_device_summaries()
+            self._save_cached('summaries', summaries)
+
+        return summaries
+
+
+    def _read_device_summaries(self):
+
         buf = None
         laps = []
 
@@ -280,39 +621,135 @@ class Track(object):
 
     @cached_property
     def storage_usage(self):
+        """
+        The size of the trackpoints and logpoints of the track. Only
+        the segment headers are read, not the points.
+        """
 
         tp = 0
-        for seg in self.trackpoints:
-            tp += 40
-            if seg:
-                tp += seg.point_size * len(seg)
         lp = 0
-        for seg in self.logpoints:
-            lp += 16
-            if seg:
-                lp += seg.point_size * len(seg)
+
+        for tp_info, lp_info in self.segment_index:
+
+            tp += _TRACKPOINT_SEGMENT_HEADER.size + \
+                TrackPointSegment.point_size * tp_info.count
+
+            lp += _LOGPOINT_SEGMENT_HEADER.size
+            if lp_info.count > 0:
+                lp += _logpoint_layout(lp_info.format)[0] * lp_info.count
 
         return dict(trackpoints=tp, logpoints=lp)
 
 
 
 
+SegmentInfo = namedtuple('SegmentInfo', [
+    'offset', 'segment_type', 'format', 'count', 'start', 'end'])
+
+
+class SegmentIndex(object):
+    """
+    The absolute offset, type, format, number of points and time range
+    of the trackpoint and logpoint segments of the tracks. The segment
+    chains of all the tracks are walked the first time the index is
+    used, without reading the points. The end of a trackpoint segment
+    is None since the time between trackpoints varies.
+    """
+
+    def __init__(self, device, tracks):
+        self.device = device
+        self.tracks = tracks
+
+
+    def segments(self, track):
+        """A list of (trackpoint SegmentInfo, logpoint SegmentInfo)."""
+
+        segments = self._segments[track._offset_trackpoints]
+        if isinstance(segments, RuntimeError):
+            raise segments
+        return segments
+
+
+    @cached_property
+    def _segments(self):
+        """
+        The segments of each track keyed by its trackpoint offset. If
+        a track can't be indexed the error is kept instead, and it's
+        only raised when the segments of that track are used.
+        """
+
+        device = self.device
+        entry = device.last_log_entry
+
+        trackpoints = {}
+        for offset in sorted(set(t._offset_trackpoints for t in self.tracks)):
+            try:
+                trackpoints[offset] = _index_trackpoint_segments(
+                    device, entry.offset_start_trackpoints, offset)
+            except RuntimeError as e:
+                trackpoints[offset] = e
+
+        # The logpoint headers are read in the order they are stored.
+        logpoints = {}
+        for offset in sorted(set(offset for segments in trackpoints.values()
+                                 if not isinstance(segments, RuntimeError)
+                                 for info, offset in segments)):
+            try:
+                logpoints[offset] = _index_logpoint_segment(
+                    device, entry.offset_start_logpoints + offset)
+            except RuntimeError as e:
+                logpoints[offset] = e
+
+        index = {}
+        for offset, segments in trackpoints.iteritems():
+            try:
+                index[offset] = _pair_segments(segments, logpoints)
+            except RuntimeError as e:
+                index[offset] = e
+
+        return index
+
+
+
+def _pair_segments(trackpoints, logpoints):
+    """
+    Returns the list of (trackpoint SegmentInfo, logpoint SegmentInfo)
+    of a track. trackpoints and the values of logpoints are errors for
+    the segments that could not be indexed.
+    """
+
+    if isinstance(trackpoints, RuntimeError):
+        raise trackpoints
+
+    segments = []
+    for info, lp_offset in trackpoints:
+        if isinstance(logpoints[lp_offset], RuntimeError):
+            raise logpoints[lp_offset]
+        segments.append((info, logpoints[lp_offset]))
+
+    for (tp1, lp1), (tp2, lp2) in zip(segments, segments[1:]):
+        end = lp1.offset + _LOGPOINT_SEGMENT_HEADER.size
+        if lp1.count > 0:
+            end += _logpoint_layout(lp1.format)[0] * lp1.count
+        if end != lp2.offset:
+            warnings.warn('Unexpected logpoint offset.', RuntimeWarning)
+
+    return segments
+
+
+
 class Summary(object):
 
-    start = None
-    end = None
-    distance = None
+    __slots__ = ('start', 'end', 'distance', 'speed', 'heartrate', 'cadence',
+                 'watts', 'calories', 'altitude_gain', 'altitude_loss',
+                 'ride_time')
 
-    speed = None
-    heartrate = None
-    cadence = None
-    watts = None
-    calories = None
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
 
-    altitude_gain = None
-    altitude_loss = None
 
-    ride_time = None
+_SUMMARY = struct.Struct('<IIIBBBBBBHHHHHI')
 
 
 
@@ -329,14 +766,20 @@ class _Segment(object):
 
     @segment_type.setter
     def segment_type(self, value):
-        if value not in self._SEGMENT_TYPES:
+        self._segment_type = self.type_index(value)
+
+
+    @classmethod
+    def type_index(cls, value):
+        """Converts a segment type from a header to the type used here."""
+        if value not in cls._SEGMENT_TYPES:
             raise RuntimeError('Unknown type ({0:x}) for {1}'.
-                               format(value, self.__class__.__name__))
-        self._segment_type = self._SEGMENT_TYPES.index(value)
+                               format(value, cls.__name__))
+        return cls._SEGMENT_TYPES.index(value)
 
 
 
-class TrackPointSegment(list, _Segment):
+class TrackPointSegment(TrackPointColumns, _Segment):
 
     _SEGMENT_TYPES = (0, 1, 2, 3, 4)
 
@@ -346,7 +789,7 @@ class TrackPointSegment(list, _Segment):
 
 
 
-class LogPointSegment(list, _Segment):
+class LogPointSegment(LogPointColumns, _Segment):
 
     _SEGMENT_TYPES = (0x02, 0x06, 0x0A, 0x0E, 0x12)
 
@@ -354,6 +797,28 @@ class LogPointSegment(list, _Segment):
 
 
 
+_HistoryEntry = namedtuple('_HistoryEntry', [
+    'timestamp', 'offset_trackpoints', 'offset_summary', 'offset_laps',
+    'offset_settings', 'lap_count', 'size', 'name_len'])
+
+_HISTORY_ENTRY = struct.Struct('<I4xIIIIB3xI6xH8x')
+
+
+_TrackPointSegmentHeader = namedtuple('_TrackPointSegmentHeader', [
+    'timestamp', 'lon_start', 'lat_start', 'lon_end', 'lat_end',
+    'elevation_start', 'elevation_end', 'format', 'segment_type',
+    'next_offset', 'count', 'offset_logpoints'])
+
+_TRACKPOINT_SEGMENT_HEADER = struct.Struct('<IiiiiHHHBxIII')
+
+
+_LogPointSegmentHeader = namedtuple('_LogPointSegmentHeader', [
+    'timestamp', 'format', 'count', 'segment_type'])
+
+_LOGPOINT_SEGMENT_HEADER = struct.Struct('<I4xHHB3x')
+
+
+
 def read_history(device):
 
 
@@ -365,445 +830,647 @@ def read_history(device):
 
     while buf.abs_position < end:
 
-        timestamp = buf.uint32_from(0x00)
-        name_len = buf.uint16_from(0x26)
+        h = _HistoryEntry._make(buf.unpack_from(_HISTORY_ENTRY, 0))
 
-        if timestamp == 0xffffffff:
+        if h.timestamp == 0xffffffff:
             # It's a planned trip
-            buf.set_offset(0x30 + name_len)
+            buf.set_offset(0x30 + h.name_len)
             continue
 
         t = Track(device)
-        t.name = buf.str_from(0x30, name_len)
-        t.timestamp = timestamp
-        t.lap_count = buf.uint8_from(0x18)
-        # t._bike_type = buf.uint16_from(0x04)
-        t._offset_trackpoints = buf.uint32_from(0x08)
-        t._offset_summary = buf.uint32_from(0x0C)
+        t.name = buf.str_from(0x30, h.name_len)
+        t.timestamp = t._history_timestamp = h.timestamp
+        t.lap_count = h.lap_count
+        t._offset_trackpoints = h.offset_trackpoints
+        t._offset_summary = h.offset_summary
         if t.lap_count > 0:
-            t._offset_laps = buf.uint32_from(0x10)
+            t._offset_laps = h.offset_laps
 
 
-        buf.set_offset(0x30 + name_len)
+        buf.set_offset(0x30 + h.name_len)
 
         history.append(t)
 
-    return history
-
+    index_segments(device, history)
 
-def _read_log_entry(buf):
+    return history
 
-    ui32 = buf.uint32_from
-    l = LogEntry()
 
-    l.space_left_history = ui32(0x58)
-    l.offset_start_history = ui32(0x5C)
-    l.offset_end_history = ui32(0x60)
+def index_segments(device, tracks):
+    """The segments of the tracks will be indexed together."""
 
-    l.space_left_laps = ui32(0x64)
-    l.offset_start_laps = ui32(0x68)
-    l.offset_end_laps = ui32(0x6C)
+    index = SegmentIndex(device, tracks)
+    for t in tracks:
+        t._segment_index = index
 
-    l.space_left_trackpoints = ui32(0x88)
-    l.offset_start_trackpoints = ui32(0x8C)
-    l.offset_end_trackpoints = ui32(0x90)
 
-    l.space_left_logpoints = ui32(0x94)
-    l.offset_start_logpoints = ui32(0x98)
-    l.offset_end_logpoints = ui32(0x9C)
+def _index_trackpoint_segments(device, trackpoints_offset, offset):
+    """
+    Walks the chain of trackpoint segments starting at offset without
+    reading the trackpoints. Returns a list of (SegmentInfo, offset of
+    the logpoint segment).
+    """
 
-    return l
+    segments = []
 
+    offset += trackpoints_offset
 
-def _read_trackpoint_segments(buf, trackpoints_offset):
+    while True:
 
-    segments = []
+        h = _TrackPointSegmentHeader._make(
+            device.read_from_offset(offset)
+            .unpack_from(_TRACKPOINT_SEGMENT_HEADER, 0))
 
-    while True:
-        seg, next_offset = _read_trackpoint_segment(buf)
+        # The first point is stored in the header and is not
+        # included in the count.
+        count = h.count + 1 if h.count > 0 or h.lon_start != -1 else 0
 
-        segments.append(seg)
+        segments.append((SegmentInfo(
+            offset, TrackPointSegment.type_index(h.segment_type), h.format,
+            count, h.timestamp, None), h.offset_logpoints))
 
         # Usually the last segment have segment type SEGMENT_LAST,
         # but sometimes this is not true, so we also check that
         # if "next_offset" is 0xffffffff it was probably the last segment.
-        if seg.segment_type == SEGMENT_LAST or next_offset == 0xffffffff:
+        if h.segment_type == SEGMENT_LAST or h.next_offset == 0xffffffff:
             break
 
-
-        next_offset += trackpoints_offset
+        next_offset = trackpoints_offset + h.next_offset
 
         # Sometimes is seems like an extra trackpoint is added
         # to a segment but is not included in the count in the segment.
-        # We have to check this and skip some bytes if necessary.
-        if buf.abs_offset + buf.rel_offset != next_offset:
+        end = offset + _TRACKPOINT_SEGMENT_HEADER.size
+        if count:
+            end += h.count * _TRACKPOINT.size
 
-            diff = next_offset - buf.abs_offset - buf.rel_offset
-            if diff > 6:
-                warnings.warn('Bigger than expected diff between segment '
-                              'offsets.', RuntimeWarning)
-            if diff < 0:
-                warnings.warn('Unexpected negative diff between segment '
-                              'offsets.', RuntimeWarning)
-            buf.set_offset(diff)
+        diff = next_offset - end
+        if diff > 6:
+            warnings.warn('Bigger than expected diff between segment '
+                          'offsets.', RuntimeWarning)
+        if diff < 0:
+            warnings.warn('Unexpected negative diff between segment '
+                          'offsets.', RuntimeWarning)
 
+        offset = next_offset
 
     return segments
 
 
-def _read_trackpoint_segment(buf):
+def _index_logpoint_segment(device, offset):
+
+    h = _read_logpoint_segment_header(device.read_from_offset(offset))
+
+    end = h.timestamp
+    if h.count > 0:
+        end += _logpoint_layout(h.format)[1] * (h.count - 1)
+
+    return SegmentInfo(offset, LogPointSegment.type_index(h.segment_type),
+                       h.format, h.count, h.timestamp, end)
+
+
+def _read_segments(device, infos, read_segment):
+    """
+    Reads the segments in infos. The same buffer is used as long as
+    the segments follow each other.
+    """
+
+    buf = None
+    segments = []
+
+    for info in infos:
+
+        if buf is None or buf.abs_position != info.offset:
+            buf = device.read_from_offset(info.offset)
+
+        segments.append(read_segment(buf))
+
+    return segments
+
+
+def _trackpoints_in_window(seg, start, end):
+    """Returns a segment with the trackpoints of seg between start and end."""
+
+    timestamps = seg.timestamps
+
+    first = 0 if start is None else bisect.bisect_left(timestamps, start)
+    last = len(timestamps) if end is None \
+        else bisect.bisect_right(timestamps, end)
+
+    if first == 0 and last == len(timestamps):
+        return seg
 
     s = TrackPointSegment()
+    s.timestamp = seg.timestamp
+    s._segment_type = seg._segment_type
+    s._offset_logpoints = seg._offset_logpoints
+
+    s.extend_arrays(seg.timestamps[first:last], seg.longitudes[first:last],
+                    seg.latitudes[first:last], seg.elevations[first:last])
+
+    return s
+
+
+def _logpoints_in_window(seg, start, end):
+    """Returns a segment with the logpoints of seg between start and end."""
+
+    timestamps = seg.timestamps
+
+    first = 0 if start is None else bisect.bisect_left(timestamps, start)
+    last = len(timestamps) if end is None \
+        else bisect.bisect_right(timestamps, end)
+
+    if first == 0 and last == len(timestamps):
+        return seg
+
+    s = LogPointSegment()
+    s.timestamp = timestamps[first] if first < last else seg.timestamp
+    s._segment_type = seg._segment_type
+    s.point_size = seg.point_size
+
+    s.extend_arrays(
+        timestamps[first:last],
+        dict((name, v[first:last]) for name, v in seg.values.iteritems()),
+        dict((name, v[first:last]) for name, v in seg.valid.iteritems()))
 
-    s.timestamp = buf.uint32_from(0x00)
-    s.segment_type = buf.uint8_from(0x1A)
+    return s
+
+
+def _read_trackpoint_segment(buf):
+
+    h = _TrackPointSegmentHeader._make(
+        buf.unpack_from(_TRACKPOINT_SEGMENT_HEADER, 0))
 
-    lon_start = buf.int32_from(0x04)
-    lat_start = buf.int32_from(0x08)
-    elevation_start = (buf.uint16_from(0x14) - 4000) / 4.0
+    s = TrackPointSegment()
 
-    count = buf.uint32_from(0x20)
+    s.timestamp = h.timestamp
+    s.segment_type = h.segment_type
+    s._offset_logpoints = h.offset_logpoints
 
-    s._offset_logpoints = buf.uint32_from(0x24)
+    elevation_start = (h.elevation_start - 4000) / 4.0
 
-    if s.segment_type == SEGMENT_BEFORE_MOVING and count > 0:
+    if s.segment_type == SEGMENT_BEFORE_MOVING and h.count > 0:
         warnings.warn("Segment type {0} is not expected to "
                       "have any trackpoints".format(SEGMENT_BEFORE_MOVING),
                       RuntimeWarning)
 
-    next_offset = buf.uint32_from(0x1c)
+    buf.set_offset(_TRACKPOINT_SEGMENT_HEADER.size)
 
+    if h.count > 0 or h.lon_start != -1:
 
-    format = buf.uint16_from(0x18)
+        buf.prefetch(h.count * s.point_size)
 
-    buf.set_offset(0x28)
-
-    if count > 0 or lon_start != -1:
-
-        if format == 0x0140:
-            track_points = _read_trackpoints_format_1(buf, s.timestamp,
-                                                      lon_start, lat_start,
-                                                      elevation_start, count)
-        elif format == 0x0440:
-            track_points = _read_trackpoints_format_2(buf, s.timestamp,
-                                                      lon_start, lat_start,
-                                                      elevation_start, count)
+        if h.format == 0x0140:
+            _read_trackpoints_format_1(buf, s, h.lon_start, h.lat_start,
+                                       elevation_start, h.count)
+        elif h.format == 0x0440:
+            _read_trackpoints_format_2(buf, s, h.lon_start, h.lat_start,
+                                       elevation_start, h.count)
         else:
             raise RuntimeError('Unknown trackpoint format. '
                                'It can probably easily be fixed if test data '
                                'is provided.')
 
-        s.extend(track_points)
+    return s
 
-    return s, next_offset
 
 
+def _read_trackpoints_format_1(buf, seg, lon, lat, ele, count):
 
-def _read_trackpoints_format_1(buf, time, lon, lat, ele, count):
+    # The time is stored in 1/4 seconds.
+    _read_trackpoints(buf, seg, lon, lat, ele, count, 4)
 
-    track_points = []
-    track_points.append(TrackPoint(
-        timestamp=time,
-        longitude=lon / 1000000.0,
-        latitude=lat / 1000000.0,
-        elevation=ele
-    ))
 
-    for i in range(count):
 
-        time += buf.uint8_from(0) / 4
-        ele += buf.int8_from(0x1) / 10.0
-        lon += buf.int16_from(0x02)
-        lat += buf.int16_from(0x04)
+def _read_trackpoints_format_2(buf, seg, lon, lat, ele, count):
 
-        track_points.append(TrackPoint(
-            timestamp=time,
-            longitude=lon / 1000000.0,
-            latitude=lat / 1000000.0,
-            elevation=ele
-        ))
+    _read_trackpoints(buf, seg, lon, lat, ele, count, 1)
 
 
-        buf.set_offset(0x6)
 
+_TRACKPOINT = struct.Struct('<Bbhh')
 
-    return track_points
 
+def _read_trackpoints(buf, seg, lon, lat, ele, count, time_div):
+    """
+    Each trackpoint stores the difference in time, elevation,
+    longitude and latitude from the previous point.
+    """
 
+    data = buf.read_from(0, count * _TRACKPOINT.size)
+    buf.set_offset(count * _TRACKPOINT.size)
 
-def _read_trackpoints_format_2(buf, time, lon, lat, ele, count):
+    time = seg.timestamp
 
-    track_points = []
-    track_points.append(TrackPoint(
-        timestamp=time,
-        longitude=lon / 1000000.0,
-        latitude=lat / 1000000.0,
-        elevation=ele
-    ))
+    if has_numpy:
+        columns = _decode_trackpoints_numpy(data, time, lon, lat, ele,
+                                            count, time_div)
+        seg.extend_arrays(*[_to_array(typecode, column) for typecode, column
+                            in zip('liid', columns)])
+        return
 
-    for i in range(count):
+    seg.add(time, lon, lat, ele)
 
-        time += buf.uint8_from(0)
-        ele += buf.int8_from(0x1) / 10.0
-        lon += buf.int16_from(0x02)
-        lat += buf.int16_from(0x04)
+    unpack_from = _TRACKPOINT.unpack_from
 
-        track_points.append(TrackPoint(
-            timestamp=time,
-            longitude=lon / 1000000.0,
-            latitude=lat / 1000000.0,
-            elevation=ele
-        ))
+    for offset in xrange(0, len(data), _TRACKPOINT.size):
 
+        time_diff, ele_diff, lon_diff, lat_diff = unpack_from(data, offset)
 
-        buf.set_offset(0x6)
+        time += time_diff / time_div
+        ele += ele_diff / 10.0
+        lon += lon_diff
+        lat += lat_diff
+
+        seg.add(time, lon, lat, ele)
+
+
+
+def _to_array(typecode, values):
+    """Copy a NumPy array to an array.array."""
+
+    a = array.array(typecode)
+    a.fromstring(np.ascontiguousarray(values, dtype=typecode).tostring())
+    return a
 
 
-    return track_points
 
+if has_numpy:
+    _TRACKPOINT_DTYPE = np.dtype([('time', 'u1'), ('elevation', 'i1'),
+                                  ('lon', '<i2'), ('lat', '<i2')])
 
 
-def _read_logpoint_segment(buf):
+def _decode_trackpoints_numpy(data, time, lon, lat, ele, count, time_div):
+    """
+    Decodes all the trackpoints of a segment at once. Returns arrays of
+    the timestamps, longitudes, latitudes (in microdegrees) and
+    elevations, including the start point from the segment header.
+    """
+
+    points = np.frombuffer(data, dtype=_TRACKPOINT_DTYPE, count=count)
+
+    times = np.empty(count + 1, dtype=np.int64)
+    times[0] = time
+    times[1:] = points['time'] // time_div
+
+    lons = np.empty(count + 1, dtype=np.int64)
+    lons[0] = lon
+    lons[1:] = points['lon']
+
+    lats = np.empty(count + 1, dtype=np.int64)
+    lats[0] = lat
+    lats[1:] = points['lat']
+
+    eles = np.empty(count + 1, dtype=np.float64)
+    eles[0] = ele
+    eles[1:] = points['elevation'] / 10.0
+
+    return np.cumsum(times), np.cumsum(lons), np.cumsum(lats), np.cumsum(eles)
+
+
+
+def _read_logpoint_segment_header(buf):
+    return _LogPointSegmentHeader._make(
+        buf.unpack_from(_LOGPOINT_SEGMENT_HEADER, 0))
+
+
+# The size of a logpoint and the seconds between each logpoint
+# for each format.
+_LOGPOINT_LAYOUTS = {
+    0x7104: (6, 4),
+    0x7504: (7, 4),
+    0x7704: (8, 4),
+    0x7f01: (10, 1),
+    0x7b01: (9, 1),
+}
+
+
+def _logpoint_layout(format):
+
+    try:
+        return _LOGPOINT_LAYOUTS[format]
+    except KeyError:
+        raise RuntimeError('Unknown logpoint format. You are probably '
+                           'using a sensor that has not been tested '
+                           'during development. Maybe a powermeter.'
+                           'It can probably easily be fixed if test data '
+                           'is provided.')
+
+
+def _read_logpoint_segment(buf, window=None):
+    """
+    Reads a logpoint segment. If window is (start, end) only the
+    points in that time window are read, the segment timestamp is
+    then the time of the first point read.
+    """
+
+    h = _read_logpoint_segment_header(buf)
 
     s = LogPointSegment()
 
-    s.timestamp = buf.uint32_from(0)
-    s.segment_type = buf.uint8_from(0x0c)
+    s.timestamp = h.timestamp
+    s.segment_type = h.segment_type
 
-    count = buf.uint16_from(0x0a)
+    count = h.count
+    format = h.format
 
-    format = buf.uint16_from(0x08)
-    
-    buf.set_offset(0x10)
+    buf.set_offset(_LOGPOINT_SEGMENT_HEADER.size)
+
+    if count > 0:
+
+        s.point_size, interval = _logpoint_layout(format)
+
+        if window is not None:
+
+            start, end = window
+
+            # The logpoints are stored with a fixed interval, so
+            # the points outside the window can be skipped.
+            first = 0
+            if start is not None and start > h.timestamp:
+                first = min(count, -(-(start - h.timestamp) // interval))
+            if end is not None:
+                count = min(count, max(0, (end - h.timestamp) // interval + 1))
+            count = max(0, count - first)
+
+            s.timestamp += first * interval
+            buf.set_offset(first * s.point_size)
 
     if count > 0:
 
         if format == 0x7104:
-            log_points = _read_logpoints_format_1(buf, s.timestamp, count)
-            s.point_size = 6
+            read_log_points = _read_logpoints_format_1
         elif format == 0x7504:
-            log_points = _read_logpoints_format_2(buf, s.timestamp, count)
-            s.point_size = 7
+            read_log_points = _read_logpoints_format_2
         elif format == 0x7704:
-            log_points = _read_logpoints_format_3(buf, s.timestamp, count)
-            s.point_size = 8
+            read_log_points = _read_logpoints_format_3
         elif format == 0x7f01:
-            log_points = _read_logpoints_format_4(buf, s.timestamp, count)
-            s.point_size = 10
-        elif format == 0x7b01:
-            log_points = _read_logpoints_format_5(buf, s.timestamp, count)
-            s.point_size = 9
+            read_log_points = _read_logpoints_format_4
         else:
-            raise RuntimeError('Unknown logpoint format. You are probably '
-                               'using a sensor that has not been tested '
-                               'during development. Maybe a powermeter.'
-                               'It can probably easily be fixed if test data '
-                               'is provided.')
+            read_log_points = _read_logpoints_format_5
 
-        s.extend(log_points)
+        buf.prefetch(count * s.point_size)
+
+        if has_numpy:
+            data = buf.read_from(0, count * s.point_size)
+            buf.set_offset(count * s.point_size)
+            _read_logpoints_numpy(data, s, count, format)
+        else:
+            read_log_points(buf, s, count)
 
     return s
 
 
 
-def _read_logpoints_format_1(buf, time, count):
+def _logpoint_dtype(itemsize, **fields):
+
+    names = sorted(fields, key=lambda name: fields[name][1])
+
+    return np.dtype({'names': names,
+                     'formats': [fields[name][0] for name in names],
+                     'offsets': [fields[name][1] for name in names],
+                     'itemsize': itemsize})
+
+
+if has_numpy:
+    # The layout of the logpoints for each format. The fields
+    # are (type, offset).
+    _LOGPOINT_FORMATS = {
+        0x7104: _logpoint_dtype(6, speed=('u1', 0),
+                                temperature=('<i2', 1),
+                                airpressure=('<u2', 3)),
+        0x7504: _logpoint_dtype(7, speed=('u1', 0),
+                                heartrate=('u1', 1),
+                                temperature=('<i2', 2),
+                                airpressure=('<u2', 4)),
+        0x7704: _logpoint_dtype(8, speed=('u1', 0),
+                                cadence=('u1', 1),
+                                heartrate=('u1', 2),
+                                temperature=('<i2', 3),
+                                airpressure=('<u2', 5)),
+        0x7f01: _logpoint_dtype(10, speed=('u1', 0),
+                                cadence=('u1', 1),
+                                heartrate=('u1', 2),
+                                watts=('<u2', 3),
+                                temperature=('<i2', 5),
+                                airpressure=('<u2', 7)),
+        0x7b01: _logpoint_dtype(9, speed=('u1', 0),
+                                cadence=('u1', 1),
+                                watts=('<u2', 2),
+                                temperature=('<i2', 5),
+                                airpressure=('<u2', 7)),
+    }
+
+
+def _decode_logpoints_numpy(data, time, count, format):
+    """
+    Decodes all the logpoints of a segment at once. Returns a dict
+    of columns. Values that are not available (0xff) are masked.
+    """
+
+    interval = _logpoint_layout(format)[1]
+    dtype = _LOGPOINT_FORMATS[format]
+
+    points = np.frombuffer(data, dtype=dtype, count=count)
+
+    columns = {}
+
+    columns['timestamp'] = time + interval * np.arange(count,
+                                                       dtype=np.int64)
+
+    speed = np.ma.masked_equal(points['speed'], 0xff)
+    columns['speed'] = speed / 8.0 * 60 * 60 / 1000
+
+    columns['temperature'] = points['temperature'] / 10.0
+    columns['airpressure'] = points['airpressure'] * 2.0
+
+    for name in ('cadence', 'heartrate', 'watts'):
+        if name in dtype.names:
+            columns[name] = np.ma.masked_equal(points[name], 0xff)
+
+    return columns
+
 
-    log_points = []
+def _read_logpoints_numpy(data, seg, count, format):
+
+    columns = _decode_logpoints_numpy(data, seg.timestamp, count, format)
+
+    values = {}
+    valid = {}
+
+    for name, typecode in seg.FIELDS:
+        if name in columns:
+            values[name] = _to_array(typecode, np.ma.filled(columns[name], 0))
+            valid[name] = _to_array('B', ~np.ma.getmaskarray(columns[name]))
+
+    seg.extend_arrays(_to_array('l', columns['timestamp']), values, valid)
+
+
+
+def _read_logpoints_format_1(buf, seg, count):
+
+    time = seg.timestamp
 
     for i in range(count):
 
         speed = buf.uint8_from(0x00)
-        speed = speed / 8.0 * 60 * 60 / 1000 if speed != 0xff else 0
+        speed = speed / 8.0 * 60 * 60 / 1000 if speed != 0xff else None
 
-        lp = LogPoint(
+        seg.add(
             timestamp=time,
             speed=speed,
             temperature=buf.int16_from(0x01) / 10.0,
             airpressure=buf.uint16_from(0x03) * 2.0
         )
 
-        log_points.append(lp)
-
         time += 4
 
         buf.set_offset(0x6)
 
 
-    return log_points
-
-
 
-def _read_logpoints_format_2(buf, time, count):
+def _read_logpoints_format_2(buf, seg, count):
 
-    log_points = []
+    time = seg.timestamp
 
     for i in range(count):
 
         speed = buf.uint8_from(0x00)
-        speed = speed / 8.0 * 60 * 60 / 1000 if speed != 0xff else 0
+        speed = speed / 8.0 * 60 * 60 / 1000 if speed != 0xff else None
 
-        lp = LogPoint(
+        hr = buf.uint8_from(0x01)
+
+        seg.add(
             timestamp=time,
             speed=speed,
+            heartrate=hr if hr != 0xff else None,
             temperature=buf.int16_from(0x02) / 10.0,
             airpressure=buf.uint16_from(0x04) * 2.0
         )
 
-        hr = buf.uint8_from(0x01)
-        if hr != 0xff:
-            lp.heartrate = hr
-
-
-        log_points.append(lp)
-
         time += 4
 
         buf.set_offset(0x7)
 
 
-    return log_points
-
-
 
-def _read_logpoints_format_3(buf, time, count):
+def _read_logpoints_format_3(buf, seg, count):
 
-    log_points = []
+    time = seg.timestamp
 
     for i in range(count):
 
         speed = buf.uint8_from(0x00)
-        speed = speed / 8.0 * 60 * 60 / 1000 if speed != 0xff else 0
+        speed = speed / 8.0 * 60 * 60 / 1000 if speed != 0xff else None
 
-        lp = LogPoint(
+        cad = buf.uint8_from(0x01)
+        hr = buf.uint8_from(0x02)
+
+        seg.add(
             timestamp=time,
             speed=speed,
+            cadence=cad if cad != 0xff else None,
+            heartrate=hr if hr != 0xff else None,
             temperature=buf.int16_from(0x03) / 10.0,
             airpressure=buf.uint16_from(0x05) * 2.0
         )
 
-        cad = buf.uint8_from(0x01)
-        if cad != 0xff:
-            lp.cadence = cad
-
-        hr = buf.uint8_from(0x02)
-        if hr != 0xff:
-            lp.heartrate = hr
-
-        log_points.append(lp)
-
         time += 4
 
         buf.set_offset(0x8)
 
 
-    return log_points
-
 
 # Power and Heartrate
-def _read_logpoints_format_4(buf, time, count):
+def _read_logpoints_format_4(buf, seg, count):
 
-    log_points = []
+    time = seg.timestamp
 
     for i in range(count):
 
         speed = buf.uint8_from(0x00)
-        speed = speed / 8.0 * 60 * 60 / 1000 if speed != 0xff else 0
-
-        lp = LogPoint(
-            timestamp=time,
-            speed=speed,
-            temperature=buf.int16_from(0x05) / 10.0,
-            airpressure=buf.uint16_from(0x07) * 2.0
-        )
+        speed = speed / 8.0 * 60 * 60 / 1000 if speed != 0xff else None
 
         cad = buf.uint8_from(0x01)
-        if cad != 0xff:
-            lp.cadence = cad
-
         hr = buf.uint8_from(0x02)
-        if hr != 0xff:
-            lp.heartrate = hr
-
         pw = buf.uint16_from(0x03)
-        if pw != 0xff:
-            lp.watts = pw
-        
+
         # buf.uint8_from(0x03) #unknown
         # buf.uint8_from(0x04) #unknown
 
-
-        log_points.append(lp)
+        seg.add(
+            timestamp=time,
+            speed=speed,
+            cadence=cad if cad != 0xff else None,
+            heartrate=hr if hr != 0xff else None,
+            watts=pw if pw != 0xff else None,
+            temperature=buf.int16_from(0x05) / 10.0,
+            airpressure=buf.uint16_from(0x07) * 2.0
+        )
 
         time += 1
 
         buf.set_offset(0xa)
 
-    return log_points
 
 # Power and NO Heartrate
-def _read_logpoints_format_5(buf, time, count):
+def _read_logpoints_format_5(buf, seg, count):
+
+    time = seg.timestamp
 
-    log_points = []
     for i in range(count):
 
         speed = buf.uint8_from(0x00)
-        speed = speed / 8.0 * 60 * 60 / 1000 if speed != 0xff else 0
+        speed = speed / 8.0 * 60 * 60 / 1000 if speed != 0xff else None
+
+        cad = buf.uint8_from(0x01)
+        w = buf.uint16_from(0x02)
 
-        lp = LogPoint(
+        seg.add(
             timestamp=time,
             speed=speed,
+            cadence=cad if cad != 0xff else None,
+            watts=w if w != 0xff else None,
             temperature=buf.int16_from(0x05) / 10.0,
             airpressure=buf.uint16_from(0x07) * 2.0
         )
 
-        cad = buf.uint8_from(0x01)
-        if cad != 0xff:
-            lp.cadence = cad
-
-        w = buf.uint16_from(0x02)
-        if w != 0xff:
-            lp.watts = w
-
-        log_points.append(lp)
-
         time += 1
 
         buf.set_offset(0x9)
 
-    return log_points
-
 def _read_summary(buf):
 
+    (start, end, distance, speed_avg, speed_max, hr_avg, hr_max, cad_avg,
+     cad_max, watts_avg, watts_max, altitude_gain, altitude_loss, calories,
+     ride_time) = buf.unpack_from(_SUMMARY, 0)
+
     s = Summary()
 
-    s.start = buf.uint32_from(0x00)
-    s.end = buf.uint32_from(0x04)
-    s.distance = buf.uint32_from(0x08)
+    s.start = start
+    s.end = end
+    s.distance = distance
 
     s.speed = AvgMax(
-        buf.uint8_from(0x0c) / 8.0 * 60 * 60 / 1000,
-        buf.uint8_from(0x0d) / 8.0 * 60 * 60 / 1000,
+        speed_avg / 8.0 * 60 * 60 / 1000,
+        speed_max / 8.0 * 60 * 60 / 1000,
     )
 
     s.heartrate = AvgMax(
-        buf.uint8_from(0x0e) if buf.uint8_from(0x0e) != 0xff else 0,
-        buf.uint8_from(0x0f) if buf.uint8_from(0x0f) != 0xff else 0,
+        hr_avg if hr_avg != 0xff else 0,
+        hr_max if hr_max != 0xff else 0,
     )
 
     s.cadence = AvgMax(
-        buf.uint8_from(0x10) if buf.uint8_from(0x10) != 0xff else 0,
-        buf.uint8_from(0x11) if buf.uint8_from(0x11) != 0xff else 0,
+        cad_avg if cad_avg != 0xff else 0,
+        cad_max if cad_max != 0xff else 0,
     )
 
-    s.watts = AvgMax(
-        buf.uint16_from(0x12),
-        buf.uint16_from(0x14),
-    )
+    s.watts = AvgMax(watts_avg, watts_max)
 
-    s.altitude_gain = buf.uint16_from(0x16)
-    s.altitude_loss = buf.uint16_from(0x18)
-    s.calories = buf.uint16_from(0x1a)
-    s.ride_time = buf.uint32_from(0x1c)
+    s.altitude_gain = altitude_gain
+    s.altitude_loss = altitude_loss
+    s.calories = calories
+    s.ride_time = ride_time
 
     return s
 
@@ -816,11 +1483,10 @@ def _merge_segments(track_seg, log_seg):
     timestamp to eachother. Points are only merged if they are 2 or less
     seconds apart.
 
-    This current implementation is quite ugly.
-
     Here is a short explanation:
 
-    The two segments are merged into one list and sorted by timestamp.
+    Both segments are already ordered by timestamp, so they are merged
+    into one stream ordered by timestamp by walking them side by side.
     Then 4 items at the time are compared.
 
     The 3 first items are potentialy merged, the last is just used
@@ -830,60 +1496,78 @@ def _merge_segments(track_seg, log_seg):
     are merged. If (1 and 2) are closest 0 is returned alone.
     """
 
+    TRACK, LOG = 0, 1
+
+    def _items():
+        # Trackpoints comes first when the timestamps are equal.
+        tt = track_seg.timestamps
+        lt = log_seg.timestamps
+        i = j = 0
+        while i < len(tt) and j < len(lt):
+            if tt[i] <= lt[j]:
+                yield (tt[i], TRACK, i)
+                i += 1
+            else:
+                yield (lt[j], LOG, j)
+                j += 1
+        for i in xrange(i, len(tt)):
+            yield (tt[i], TRACK, i)
+        for j in xrange(j, len(lt)):
+            yield (lt[j], LOG, j)
+
     def _point(a, b):
 
-        if type(a) == type(b):
+        if b is not None and a[1] == b[1]:
             raise RuntimeError("Can not merge logpoint/trackpoint of same type."
                                " This should not happend, it's a bug in the code.")
 
-        if isinstance(a, TrackPoint):
-            return (a, b)
-        elif isinstance(b, TrackPoint) or b is None:
-            return (b, a)
-        return (a, b)
+        tp = lp = None
+        for item in (a, b):
+            if item is None:
+                continue
+            if item[1] == TRACK:
+                tp = track_seg[item[2]]
+            else:
+                lp = log_seg[item[2]]
+        return (tp, lp)
 
-    items = sorted(itertools.chain(track_seg, log_seg),
-                   key=lambda x: x.timestamp)
+    items = _items()
 
-    l = items[0:4]
-    count = i = len(l)
+    l = deque(itertools.islice(items, 4))
+    count = len(l)
     while count > 1:
 
-        if l[0].timestamp == l[1].timestamp:
-            if type(l[0]) == type(l[1]):
-                yield _point(l.pop(0), None)
+        if l[0][0] == l[1][0]:
+            if l[0][1] == l[1][1]:
+                yield _point(l.popleft(), None)
             else:
-                yield _point(l.pop(0), l.pop(0))
-        elif l[1].timestamp - l[0].timestamp > 2:
-            yield _point(l.pop(0), None)
-        elif type(l[0]) == type(l[1]):
-            yield _point(l.pop(0), None)
-        elif count > 2 and type(l[1]) == type(l[2]):
-            yield _point(l.pop(0), l.pop(0))
-        elif count > 3 and l[2].timestamp == l[3].timestamp:
-            yield _point(l.pop(0), l.pop(0))
+                yield _point(l.popleft(), l.popleft())
+        elif l[1][0] - l[0][0] > 2:
+            yield _point(l.popleft(), None)
+        elif l[0][1] == l[1][1]:
+            yield _point(l.popleft(), None)
+        elif count > 2 and l[1][1] == l[2][1]:
+            yield _point(l.popleft(), l.popleft())
+        elif count > 3 and l[2][0] == l[3][0]:
+            yield _point(l.popleft(), l.popleft())
         elif count > 2:
-            diff1 = l[1].timestamp - l[0].timestamp
-            diff2 = l[2].timestamp - l[1].timestamp
+            diff1 = l[1][0] - l[0][0]
+            diff2 = l[2][0] - l[1][0]
             if diff1 > diff2:
-                yield _point(l.pop(0), None)
-                yield _point(l.pop(0), l.pop(0))
+                yield _point(l.popleft(), None)
+                yield _point(l.popleft(), l.popleft())
             else:
-                yield _point(l.pop(0), l.pop(0))
+                yield _point(l.popleft(), l.popleft())
         else:
-            if l[1].timestamp - l[0].timestamp <= 2:
-                yield _point(l.pop(0), l.pop(0))
+            if l[1][0] - l[0][0] <= 2:
+                yield _point(l.popleft(), l.popleft())
             else:
-                yield _point(l.pop(0), None)
-                yield _point(l.pop(0), None)
+                yield _point(l.popleft(), None)
+                yield _point(l.popleft(), None)
 
-        more = 4 - len(l)
-        l.extend(items[i:i + more])  # Add back as many as was removed
-        i += more
+        # Add back as many as was removed
+        l.extend(itertools.islice(items, 4 - len(l)))
         count = len(l)
 
     if l:
         yield _point(l[0], None)
-
-
-
@@ -20,7 +20,7 @@
 import json
 import urllib2
 
-import cStringIO as StringIO
+import tempfile
 
 try:
     import mechanize
@@ -106,11 +106,14 @@ class StravaUploader(object):
             raise StravaError('Upload form not found')
 
 
-        data = tcx.track_to_tcx(track, fake_garmin_device= \
-                                      self.fake_garmin_device,
-                                    no_laps=self.no_laps)
+        # The TCX is streamed to a temporary file instead of being
+        # built in memory, mechanize reads it when the form is submitted.
+        data = tempfile.TemporaryFile()
+        tcx.write_tcx(track, data, fake_garmin_device=self.fake_garmin_device,
+                      no_laps=self.no_laps)
+        data.seek(0)
 
-        self.browser.form.add_file(StringIO.StringIO(data),
+        self.browser.form.add_file(data,
                                    'text/plain',
                                    track.name + '.tcx')
 
@@ -118,6 +121,8 @@ class StravaUploader(object):
             self.browser.submit()
         except mechanize.HTTPError as e:
             raise StravaError(str(e))
+        finally:
+            data.close()
 
         resp = _get_response(self.browser)
 
@@ -17,24 +17,16 @@
 # along with Bryton-GPS-Linux.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from xml.etree import cElementTree as xml
+import cStringIO as StringIO
 
-
-from utils import indent_element_tree
-from gpx import format_timestamp, _ns, xsi_ns
+from utils import XmlWriter, export_track
+from gpx import format_timestamp
 
 _TCX_NS = "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"
 _TCX_NS_XSD = "http://www.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd"
 _ACT_EXT_NS = 'http://www.garmin.com/xmlschemas/ActivityExtension/v2'
 _ACT_EXT_NS_XSD = 'http://www.garmin.com/xmlschemas/ActivityExtensionv2.xsd'
-
-
-def tcx_ns(name):
-    return _ns(name, _TCX_NS)
-
-
-def aext_ns(name):
-    return _ns(name, _ACT_EXT_NS)
+_XSI_NS = "http://www.w3.org/2001/XMLSchema-instance"
 
 
 def kph_to_ms(value):
@@ -42,242 +34,254 @@ def kph_to_ms(value):
     return value * 1000 / 3600
 
 
-def create_sub_value(parent, name, text, ns=tcx_ns):
-
-    el = xml.SubElement(parent, name)
-    xml.SubElement(el, ns('Value')).text = text
+def write_sub_value(w, name, text):
 
+    w.start(name)
+    w.element('Value', text)
+    w.end()
 
-def create_lap(sum, parent, ns=tcx_ns):
 
-    lap = xml.SubElement(parent, ns('Lap'))
+def write_lap(w, sum):
+    """Starts a lap, the caller has to end it."""
 
-    lap.set(ns('StartTime'), format_timestamp(sum.start))
+    w.start('Lap', (('StartTime', format_timestamp(sum.start)),))
 
-    xml.SubElement(lap, ns('TotalTimeSeconds')).text = \
-        format(sum.end - sum.start, '.1f')
-    xml.SubElement(lap, ns('DistanceMeters')).text = \
-        format(sum.distance, '.1f')
-    xml.SubElement(lap, ns('MaximumSpeed')).text = \
-        format(kph_to_ms(sum.speed.max), '.2f')
-    xml.SubElement(lap, ns('Calories')).text = \
-        format(sum.calories, 'd')
+    w.element('TotalTimeSeconds', format(sum.end - sum.start, '.1f'))
+    w.element('DistanceMeters', format(sum.distance, '.1f'))
+    w.element('MaximumSpeed', format(kph_to_ms(sum.speed.max), '.2f'))
+    w.element('Calories', format(sum.calories, 'd'))
 
     if sum.heartrate is not None and sum.heartrate.max > 0:
 
-        create_sub_value(lap, ns('AverageHeartRateBpm'),
-                         format(sum.heartrate.avg, 'd'))
-        create_sub_value(lap, ns('MaximumHeartRateBpm'),
-                         format(sum.heartrate.max, 'd'))
+        write_sub_value(w, 'AverageHeartRateBpm',
+                        format(sum.heartrate.avg, 'd'))
+        write_sub_value(w, 'MaximumHeartRateBpm',
+                        format(sum.heartrate.max, 'd'))
 
-    xml.SubElement(lap, ns('Intensity')).text = 'Active'
+    w.element('Intensity', 'Active')
 
     if sum.cadence is not None and sum.cadence.max > 0:
-        xml.SubElement(lap, ns('Cadence')).text = format(sum.cadence.avg, 'd')
-
-    xml.SubElement(lap, ns('TriggerMethod')).text = 'Manual'
-
-    return lap
+        w.element('Cadence', format(sum.cadence.avg, 'd'))
 
+    w.element('TriggerMethod', 'Manual')
 
-def create_track(seg, parent, ns=tcx_ns):
 
-    track = xml.SubElement(parent, ns('Track'))
+def write_trackpoint(w, tp, lp):
 
-    for tp, lp in seg:
-        create_trackpoint(tp, lp, track, ns)
+    w.start('Trackpoint')
 
-
-def create_trackpoint(tp, lp, parent, ns=tcx_ns):
-
-    p = xml.SubElement(parent, ns('Trackpoint'))
-
-    xml.SubElement(p, ns('Time')).text = \
-        format_timestamp(tp and tp.timestamp or lp.timestamp)
+    w.element('Time', format_timestamp(tp and tp.timestamp or lp.timestamp))
 
     if tp:
-        create_position(tp, p, ns)
-        xml.SubElement(p, ns('AltitudeMeters')).text = format(tp.elevation, '.1f')
+        write_position(w, tp)
+        w.element('AltitudeMeters', format(tp.elevation, '.1f'))
 
     if lp and lp.heartrate is not None:
-        create_sub_value(p, ns('HeartRateBpm'), format(lp.heartrate, 'd'))
+        write_sub_value(w, 'HeartRateBpm', format(lp.heartrate, 'd'))
     if lp and lp.cadence is not None:
-        xml.SubElement(p, ns('Cadence')).text = format(lp.cadence, 'd')
+        w.element('Cadence', format(lp.cadence, 'd'))
     if lp and lp.speed > 0:
-        create_tpx(lp, p)
-
+        write_tpx(w, lp)
 
-def create_tpx(lp, parent, ns=aext_ns):
+    w.end()
 
-    tpx = create_ext(parent, ns('TPX'))
 
-    xml.SubElement(tpx, ns('Speed')).text = format(kph_to_ms(lp.speed), '.2f')
+def write_tpx(w, lp):
 
-    if lp.watts is not None:
-        xml.SubElement(tpx, ns('Watts')).text = format(lp.watts, 'd')
+    w.start('Extensions')
+    w.start('ns3:TPX')
 
+    w.element('ns3:Speed', format(kph_to_ms(lp.speed), '.2f'))
 
+    if lp.watts is not None:
+        w.element('ns3:Watts', format(lp.watts, 'd'))
 
-def create_ext(parent, name, ns=tcx_ns):
+    w.end()
+    w.end()
 
-    el = xml.SubElement(parent, ns('Extensions'))
-    return xml.SubElement(el, name)
 
+def write_position(w, tp):
 
-def create_position(tp, parent, ns=tcx_ns):
+    w.start('Position')
 
-    pos = xml.SubElement(parent, ns('Position'))
+    w.element('LatitudeDegrees', format(tp.latitude, '.6f'))
+    w.element('LongitudeDegrees', format(tp.longitude, '.6f'))
 
-    xml.SubElement(pos, ns('LatitudeDegrees')).text = format(tp.latitude,
-                                                             '.6f')
-    xml.SubElement(pos, ns('LongitudeDegrees')).text = format(tp.longitude,
-                                                              '.6f')
+    w.end()
 
 
-def create_lap_ext(sum, parent, ns=aext_ns):
+def write_lap_ext(w, sum):
 
-    lx = create_ext(parent, ns('LX'))
+    w.start('Extensions')
+    w.start('ns3:LX')
 
-    xml.SubElement(lx, ns('AvgSpeed')).text = \
-        format(kph_to_ms(sum.speed.avg), '.2f')
+    w.element('ns3:AvgSpeed', format(kph_to_ms(sum.speed.avg), '.2f'))
 
     if sum.cadence is not None and sum.cadence.max > 0:
-        xml.SubElement(lx, ns('MaxBikeCadence')).text = \
-            format(sum.cadence.max, 'd')
+        w.element('ns3:MaxBikeCadence', format(sum.cadence.max, 'd'))
 
     if sum.watts is not None and sum.watts.max > 0:
 
-        xml.SubElement(lx, ns('AvgWatts')).text = format(sum.watts.avg, 'd')
-        xml.SubElement(lx, ns('MaxWatts')).text = format(sum.watts.max, 'd')
+        w.element('ns3:AvgWatts', format(sum.watts.avg, 'd'))
+        w.element('ns3:MaxWatts', format(sum.watts.max, 'd'))
 
+    w.end()
+    w.end()
 
-def create_laps(track, no_laps, parent, ns=tcx_ns):
 
-    for sum, segments in _get_lap_trackpoints(track, no_laps):
+def write_fake_creator_element(w):
+    """Add fake creator to make strava.com trust the elevation data"""
 
-        lap = create_lap(sum, parent, ns)
+    w.start('Creator', (('xsi:type', 'Device_t'),))
 
-        for seg in segments:
-            if seg:
-                create_track(seg, lap, ns)
+    w.element('Name', 'Garmin Edge 800')
+    w.element('UnitId', '9999999')
+    w.element('ProductID', '1169')
 
-        create_lap_ext(sum, lap)
+    w.start('Version')
+    w.element('VersionMajor', '0')
+    w.element('VersionMinor', '0')
+    w.element('BuildMajor', '0')
+    w.element('BuildMinor', '0')
+    w.end()
 
+    w.end()
 
 
-def create_fake_creator_element(parent, ns=tcx_ns):
-    """Add fake creator to make strava.com trust the elevation data"""
 
-    creator = xml.SubElement(parent, ns('Creator'))
-    creator.set(xsi_ns('type'), 'Device_t')
+def write_author_element(w):
 
-    xml.SubElement(creator, ns('Name')).text = 'Garmin Edge 800'
-    xml.SubElement(creator, ns('UnitId')).text = '9999999'
-    xml.SubElement(creator, ns('ProductID')).text = '1169'
+    w.start('Author', (('xsi:type', 'Application_t'),))
 
-    version = xml.SubElement(creator, ns('Version'))
-    xml.SubElement(version, ns('VersionMajor')).text = '0'
-    xml.SubElement(version, ns('VersionMinor')).text = '0'
-    xml.SubElement(version, ns('BuildMajor')).text = '0'
-    xml.SubElement(version, ns('BuildMinor')).text = '0'
+    w.element('Name', 'Bryton GPS Linux')
 
+    w.start('Build')
+    w.start('Version')
+    w.element('VersionMajor', '0')
+    w.element('VersionMinor', '1')
+    w.element('BuildMajor', '0')
+    w.element('BuildMinor', '0')
+    w.end()
+    w.end()
 
+    w.element('LangID', 'en')
+    w.element('PartNumber', '000-D123-00')
 
-def create_author_element(parent, ns=tcx_ns):
+    w.end()
 
-    author = xml.SubElement(parent, ns('Author'))
-    author.set(xsi_ns('type'), 'Application_t')
 
-    xml.SubElement(author, ns('Name')).text = 'Bryton GPS Linux'
 
-    build = xml.SubElement(author, ns('Build'))
-    version = xml.SubElement(build, ns('Version'))
-    xml.SubElement(version, ns('VersionMajor')).text = '0'
-    xml.SubElement(version, ns('VersionMinor')).text = '1'
-    xml.SubElement(version, ns('BuildMajor')).text = '0'
-    xml.SubElement(version, ns('BuildMinor')).text = '0'
+class TcxExporter(object):
+    """
+    Writes the laps with the trackpoints that belong to them.
+    A new lap is started when a point is past the end of the
+    current lap.
+    """
 
-    xml.SubElement(author, ns('LangID')).text = 'en'
-    xml.SubElement(author, ns('PartNumber')).text = '000-D123-00'
+    merged = True
 
+    def __init__(self, f, pretty=False, fake_garmin_device=False,
+                 no_laps=False):
+        self.w = XmlWriter(f, pretty)
+        self.fake_garmin_device = fake_garmin_device
+        self.no_laps = no_laps
 
+    def start(self, track):
 
-def track_to_tcx(track, pretty=False, fake_garmin_device=False, no_laps=False):
+        w = self.w
 
-    ns = tcx_ns
+        w.declaration()
 
-    root = xml.Element(ns('TrainingCenterDatabase'))
+        # A lot of software seems to be hardcoded to use the ns3 prefix.
+        w.start('TrainingCenterDatabase', (
+            ('xmlns', _TCX_NS),
+            ('xmlns:ns3', _ACT_EXT_NS),
+            ('xmlns:xsi', _XSI_NS),
+            ('xsi:schemaLocation', ' '.join([
+                _TCX_NS, _TCX_NS_XSD, _ACT_EXT_NS, _ACT_EXT_NS_XSD]))))
 
-    root.set(xsi_ns('schemaLocation'), ' '.join([
-        _TCX_NS, _TCX_NS_XSD, _ACT_EXT_NS, _ACT_EXT_NS_XSD]))
+        w.start('Activities')
+        w.start('Activity', (('Sport', 'Biking'),))
 
+        w.element('Id', format_timestamp(track.timestamp))
 
-    xml.register_namespace('', _TCX_NS)
-    xml.register_namespace('_ns3', _ACT_EXT_NS)
+        if self.no_laps:
+            self.summaries = [track.summary]
+        else:
+            self.summaries = track.lap_summaries[:]
 
-    activities = xml.SubElement(root, ns('Activities'))
-    activity = xml.SubElement(activities, ns('Activity'))
-    activity.set(ns('Sport'), 'Biking')
+        self.lap = self.summaries.pop(0)
+        write_lap(w, self.lap)
 
-    xml.SubElement(activity, ns('Id')).text = \
-        format_timestamp(track.timestamp)
+        self.first = True
 
+    def segment(self, tseg, lseg, merged):
 
-    create_laps(track, no_laps, activity, ns)
+        if self.first:
+            # Sometimes the first segment is a small segment without
+            # trackpoints. We just remove this, Bryton's own software
+            # seems to be doing the same.
+            self.first = False
+            if len(merged) < 5:
+                # If it contains no trackpoints we remove it.
+                if not [1 for tp, lp in merged if tp is not None]:
+                    return
 
-    if fake_garmin_device:
-        create_fake_creator_element(activity, ns)
+        w = self.w
+        summaries = self.summaries
+        in_track = False
 
+        for tp, lp in merged:
 
-    create_author_element(root, ns)
+            timestamp = tp.timestamp if tp is not None else lp.timestamp
 
-    if pretty:
-        indent_element_tree(root, ws=' ')
+            if timestamp >= self.lap.end and summaries:
 
-    out = xml.tostring(root)
+                if in_track:
+                    w.end()
+                    in_track = False
 
-    # ElementTree doesn't let me set prefix ns3 and a lot of software
-    # seems to be hardcoded to use ns3 so have to use this little hack.
-    out = out.replace('_ns3:', 'ns3:').replace('xmlns:_ns3', 'xmlns:ns3')
+                write_lap_ext(w, self.lap)
+                w.end()
 
-    return "<?xml version='1.0' encoding='utf-8'?>\n" + out
+                self.lap = summaries.pop(0)
+                write_lap(w, self.lap)
 
+            if not in_track:
+                w.start('Track')
+                in_track = True
 
-def _get_lap_trackpoints(track, no_laps):
+            write_trackpoint(w, tp, lp)
 
-    if no_laps:
-        summaries = [track.summary]
-    else:
-        summaries = track.lap_summaries[:]
+        if in_track:
+            w.end()
 
-    lap = (summaries.pop(0), [[]])
-    laps = [lap]
-    first = True
+    def finish(self):
 
-    for seg in track.merged_segments(remove_empty_track_segs=False):
+        w = self.w
 
-        if first:
-            # Sometimes the first segment is a small segment without
-            # trackpoints. We just remove this, Bryton's own software
-            # seems to be doing the same.
-            first = False
-            seg = list(seg)
-            if len(seg) < 5:
-                # If it contains no trackpoints we remove it.
-                if not [1 for tp, lp in seg if tp is not None]:
-                    continue
+        write_lap_ext(w, self.lap)
+        w.end()
 
-        for tp, lp in seg:
+        if self.fake_garmin_device:
+            write_fake_creator_element(w)
 
-            timestamp = tp.timestamp if tp is not None else lp.timestamp
+        w.end()
+        w.end()
+
+        write_author_element(w)
 
-            if timestamp < lap[0].end or not summaries:
-                lap[1][-1].append((tp, lp))
-            else:
-                lap = (summaries.pop(0), [[(tp, lp)]])
-                laps.append(lap)
+        w.end()
 
-        lap[1].append([])
 
-    return laps
+def write_tcx(track, f, pretty=False, fake_garmin_device=False,
+              no_laps=False):
+
+    export_track(track, [TcxExporter(f, pretty, fake_garmin_device, no_laps)])
+
+
+def track_to_tcx(track, pretty=False, fake_garmin_device=False, no_laps=False):
 
+    f = StringIO.StringIO()
+    write_tcx(track, f, pretty, fake_garmin_device, no_laps)
+    return f.getvalue()
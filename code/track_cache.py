@@ -0,0 +1,74 @@
+#
+# Copyright (C) 2012  Per Myren
+#
+# This file is part of Bryton-GPS-Linux
+#
+# Bryton-GPS-Linux is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Bryton-GPS-Linux is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Bryton-GPS-Linux.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import os
+import zlib
+import cPickle as pickle
+
+from utils import config_path, write_file_atomic
+
+
+class TrackCache(object):
+    """
+    Decoded tracks stored on disk in a directory for each device.
+    Each kind of entry of a track (like the points, the summaries or
+    the segment index) is a compressed pickle of its own, so the small
+    entries can be read without the points. Entries that can't be read
+    are treated as missing.
+    """
+
+    # Changed when the stored objects change.
+    VERSION = 3
+
+    def __init__(self, serial, path=None):
+        if path is None:
+            path = config_path('cache', serial)
+        self.path = path
+
+    def _path(self, key, kind):
+        return os.path.join(self.path, '-'.join(map(str, key)) + '.' + kind)
+
+    def load(self, key, kind):
+
+        try:
+            with open(self._path(key, kind), 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+
+        try:
+            version, entry = pickle.loads(zlib.decompress(data))
+        except Exception:
+            return None
+
+        if version != self.VERSION:
+            return None
+
+        return entry
+
+    def save(self, key, kind, entry):
+
+        data = zlib.compress(pickle.dumps((self.VERSION, entry),
+                                          pickle.HIGHEST_PROTOCOL))
+
+        try:
+            write_file_atomic(self._path(key, kind), data)
+        except (IOError, OSError):
+            pass
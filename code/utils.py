@@ -17,10 +17,37 @@
 # along with Bryton-GPS-Linux.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import os
+
+from xml.sax.saxutils import escape
+
 
 _missing = object()
 
 
+CONFIG_DIR = os.path.join(os.path.expanduser('~'), '.brytongps')
+
+
+def config_path(*parts):
+    return os.path.join(CONFIG_DIR, *parts)
+
+
+def write_file_atomic(path, data):
+    """
+    Writes data to a temporary file and renames it to path, so a
+    partly written file is never seen at path.
+    """
+
+    dir_name = os.path.dirname(path)
+    if dir_name and not os.path.isdir(dir_name):
+        os.makedirs(dir_name)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
 #
 # Taken from https://github.com/mitsuhiko/werkzeug
 #
@@ -68,18 +95,93 @@ class cached_property(object):
 
 
 
-def indent_element_tree(elem, level=0, ws='  '):
-    i = "\n" + level * ws
-    if len(elem):
-        if not elem.text or not elem.text.strip():
-            elem.text = i + ws
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-        for elem in elem:
-            indent_element_tree(elem, level + 1, ws)
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
+def _escape_attr(value):
+    return escape(value, {'"': '&quot;', '\n': '&#10;'})
+
+
+
+class XmlWriter(object):
+    """
+    Writes XML to a file object while it's generated, so the whole
+    document never has to be kept in memory.
+
+    When pretty is True each element is on its own line, indented
+    with ws for each level.
+    """
+
+    def __init__(self, f, pretty=False, ws=' '):
+        self.f = f
+        self.pretty = pretty
+        self.ws = ws
+        self._tags = []
+        # True when the start tag of the current element is not closed.
+        self._open = False
+
+    def declaration(self):
+        self.f.write("<?xml version='1.0' encoding='utf-8'?>\n")
+
+    def start(self, tag, attrs=()):
+
+        self._child()
+
+        self.f.write('<' + tag + self._attrs(attrs))
+
+        self._tags.append(tag)
+        self._open = True
+
+    def end(self):
+
+        tag = self._tags.pop()
+
+        if self._open:
+            self.f.write(' />')
+        elif self.pretty:
+            self.f.write('\n' + self.ws * len(self._tags) + '</' + tag + '>')
+            if not self._tags:
+                self.f.write('\n')
+        else:
+            self.f.write('</' + tag + '>')
+
+        self._open = False
+
+    def element(self, tag, text, attrs=()):
+
+        self._child()
+
+        self.f.write('<{0}{1}>{2}</{0}>'.format(tag, self._attrs(attrs),
+                                                escape(text)))
+
+    def _child(self):
+
+        if self._open:
+            self.f.write('>')
+            self._open = False
+
+        if self.pretty and self._tags:
+            self.f.write('\n' + self.ws * len(self._tags))
+
+    def _attrs(self, attrs):
+        return ''.join(' {0}="{1}"'.format(k, _escape_attr(v))
+                       for k, v in attrs)
+
+
+
+def export_track(track, exporters):
+    """
+    Passes the segments of the track to all the exporters in a single
+    traversal, the segments are only merged once. An exporter has the
+    methods start(track), segment(trackpoints, logpoints, merged) and
+    finish(), merged is None unless the exporter has merged set to true.
+    """
+
+    for e in exporters:
+        e.start(track)
+
+    merge = any(e.merged for e in exporters)
+
+    for tseg, lseg, merged in track.segments(merge):
+        for e in exporters:
+            e.segment(tseg, lseg, merged)
 
+    for e in exporters:
+        e.finish()
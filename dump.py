@@ -21,15 +21,25 @@ from __future__ import print_function
 
 import glob
 import errno
+import os
 import struct
 import sys
 import argparse
 
+from collections import namedtuple
+
 try:
     import py_sg
+    has_py_sg = True
 except ImportError, e:
-    print('You need to install the "py_sg" module.')
-    sys.exit(1)
+    has_py_sg = False
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'code'))
+
+import image_file
+import block_store
+from image_file import BLOCK_SIZE, LOG_SIZE, last_log_entry
 
 
 def find_device():
@@ -90,7 +100,7 @@ def read_serial(dev):
     return py_sg.read(dev, pack_scsi_cmd(cmd), 2048)[-16:]
 
 
-def read_block(dev, addr):
+def read_block(dev, addr, count=1):
     """
     SCSI Read(10) command with byte nr. 7 set to 0x10
     will return the data on the device in blocks of 4096 bytes.
@@ -98,7 +108,7 @@ def read_block(dev, addr):
 
     cmd = [0x28, 0, 0, 0, 0, 0, 0x10, 0, 0, 0]
 
-    blocks = 8
+    blocks = 8 * count
 
     a = struct.pack('>I', addr)
     cmd[2] = ord(a[0])
@@ -117,12 +127,301 @@ def read_block(dev, addr):
 
 
 
-def dump_device(dev, output):
+# The largest number of 4096 byte blocks to try to read with one command.
+MAX_TRANSFER_BLOCKS = 32
+
+BLOCK_COUNT = 0x1ff
+
+
+
+class BlockReader(object):
+    """
+    Reads as many blocks as possible with each command. If the device
+    refuses a transfer size, it's halved until the device accepts it,
+    and that size is used for the rest of the reads.
+    """
+
+    def __init__(self, dev):
+        self.dev = dev
+        self.count = MAX_TRANSFER_BLOCKS
+        self.blocks_read = 0
+
+    def read(self, addr, end):
+        """Yields the data of the blocks from addr up to end."""
+
+        while addr < end:
+
+            n = min(self.count, end - addr)
+
+            try:
+                data = read_block(self.dev, addr, n)
+            except (py_sg.SCSIError, EnvironmentError):
+                if self.count == 1:
+                    raise
+                self.count /= 2
+                continue
+
+            if len(data) != BLOCK_SIZE * n:
+                if self.count == 1:
+                    raise RuntimeError('Short read from device.')
+                self.count /= 2
+                continue
+
+            self.blocks_read += n
+            addr += n
+
+            yield data
+
+
+
+def read_image(path):
+    """Returns (data, serial) for a raw image, sparse image or manifest."""
+
+    try:
+        with open(path, 'rb') as f:
+            if not block_store.is_manifest(f):
+                return image_file.read_image(path)
+            image = block_store.ManifestImage(f)
+            return image.read(0, len(image)), image.serial
+    except IOError as e:
+        raise RuntimeError('Failed to read "{0}" ({1}).'.format(
+            path, e.strerror or e))
+
+
+def write_image(output, data, sparse=False, serial='', store=None):
+
+    if store is not None:
+        new = block_store.BlockStore(store).add(output, data, serial)
+        print('Stored {0} new blocks.'.format(new))
+        return
 
     with open(output, 'wb') as f:
+        if sparse:
+            image_file.write_sparse_image(f, data, serial)
+        else:
+            f.write(data)
+
+
+def dump_device(dev, output, sparse=False, store=None):
+
+    reader = BlockReader(dev)
+
+    data = ''.join(reader.read(0, BLOCK_COUNT))
+
+    write_image(output, data, sparse, read_serial(dev), store)
+
+
+def convert_image(image, output, sparse=False, store=None):
+    """Converts a raw image, sparse image or manifest to another format."""
+
+    data, serial = read_image(image)
+
+    write_image(output, data, sparse, serial, store)
+
+
+
+def _region_blocks(start, end):
+    return set(xrange(start // BLOCK_SIZE,
+                      min(BLOCK_COUNT, (end + BLOCK_SIZE - 1) // BLOCK_SIZE)))
+
+
+Area = namedtuple('Area', ['left', 'start', 'end'])
+
+# The space left, start offset and end offset of each area in the log
+# entry, see the Rider40 notes. The space left for POIs is 16 bits.
+_LOG_AREAS = (
+    ('poi', 0x42, struct.Struct('<HII')),
+    ('workouts_tests', 0x4c, struct.Struct('<3I')),
+    ('history', 0x58, struct.Struct('<3I')),
+    ('laps', 0x64, struct.Struct('<3I')),
+    ('workouts', 0x70, struct.Struct('<3I')),
+    ('workout_logs', 0x7c, struct.Struct('<3I')),
+    ('trackpoints', 0x88, struct.Struct('<3I')),
+    ('logpoints', 0x94, struct.Struct('<3I')),
+    ('settings', 0xa0, struct.Struct('<3I')),
+)
+
+# The header of the POI area, with the number of POIs and the offset
+# of the last one, is rewritten when a POI is added.
+_REWRITTEN_AREAS = ('poi',)
+
+
+def log_areas(log):
+    """Returns the Area of each area in the last log entry of the log."""
+
+    entry = last_log_entry(log)
+
+    return dict((name, Area._make(layout.unpack_from(entry, offset)))
+                for name, offset, layout in _LOG_AREAS)
+
 
-        for i in range(0x1ff):
-            f.write(read_block(dev, i))
+def _area_blocks(area):
+    return _region_blocks(area.start, area.end + area.left)
+
+
+# The end of the laps area is the start of the last lap summary, which
+# is 56 bytes.
+_LAP_SIZE = 56
+
+# The track list header before the history, with the number of tracks
+# and the offset of the last one.
+_TRACK_LIST_HEADER_SIZE = 0x18
+
+# The timestamp, trackpoint offset and name length of a history entry.
+_HISTORY_ENTRY = struct.Struct('<I4xI26xH')
+
+# The segment type, next offset and logpoint offset of a trackpoint
+# segment header.
+_TRACKPOINT_SEGMENT = struct.Struct('<26xBxI4xI')
+
+_SEGMENT_LAST = 3
+
+
+def last_records(image, areas):
+    """
+    Returns the offset of the last record in each area of the image
+    that's known, for the areas from log_areas(). The last history
+    entry and lap summary are filled in when the next ones are added,
+    and so might the last trackpoint and logpoint segments.
+    """
+
+    last = {'laps': areas['laps'].end}
+
+    history = areas['history']
+    trackpoints = areas['trackpoints'].start
+    logpoints = areas['logpoints'].start
+
+    try:
+        track = None
+        offset = history.start
+        while offset < history.end:
+            timestamp, offset_trackpoints, name_len = \
+                _HISTORY_ENTRY.unpack_from(image, offset)
+            last['history'] = offset
+            if timestamp != 0xffffffff:
+                track = offset_trackpoints
+            offset += 0x30 + name_len
+
+        if track is None:
+            return last
+
+        offset = trackpoints + track
+        while True:
+            segment_type, next_offset, offset_logpoints = \
+                _TRACKPOINT_SEGMENT.unpack_from(image, offset)
+            if segment_type == _SEGMENT_LAST or next_offset == 0xffffffff:
+                break
+            if trackpoints + next_offset <= offset:
+                return last
+            offset = trackpoints + next_offset
+
+    except struct.error:
+        return last
+
+    last['trackpoints'] = offset
+    last['logpoints'] = logpoints + offset_logpoints
+
+    return last
+
+
+def changed_blocks(old, new, last):
+    """
+    Returns the blocks that may have changed between the areas old
+    and new from log_areas(). Records are appended to the areas, but
+    the last record of an area can be filled in when the next one is
+    added, so an area is read from the block with the start of its
+    last record in last, from last_records(). The areas with no known
+    last record, or that have been moved, have shrunk or are rewritten
+    in place, are read in full when they change. The log and the
+    blocks that are not in any area are always read.
+    """
+
+    blocks = _region_blocks(0, LOG_SIZE)
+    covered = set()
+
+    for name, new_area in new.iteritems():
+
+        old_area = old[name]
+
+        covered |= _area_blocks(new_area)
+
+        if old_area == new_area:
+            continue
+
+        if name in _REWRITTEN_AREAS or old_area.start != new_area.start or \
+                new_area.end < old_area.end or \
+                old_area.end + old_area.left != new_area.end + new_area.left:
+            blocks |= _area_blocks(old_area)
+            blocks |= _area_blocks(new_area)
+        elif name in last and \
+                old_area.start <= last[name] <= old_area.end:
+            end = new_area.end
+            if name == 'laps':
+                end += _LAP_SIZE
+            blocks |= _region_blocks(last[name], end)
+        else:
+            blocks |= _area_blocks(new_area)
+
+    # The track list header is rewritten when a track is added.
+    history = new['history']
+    if history != old['history']:
+        blocks |= _region_blocks(history.start - _TRACK_LIST_HEADER_SIZE,
+                                 history.start)
+
+    blocks |= set(xrange(BLOCK_COUNT)) - covered
+
+    return blocks
+
+
+def dump_device_incremental(dev, output, base_path, sparse=False,
+                            store=None):
+    """
+    Makes a full image of the device, but only the blocks that
+    have changed since the image base_path are read from the device.
+    """
+
+    base, base_serial = read_image(base_path)
+
+    if len(base) != BLOCK_COUNT * BLOCK_SIZE:
+        raise RuntimeError('"{0}" is not a complete device image.'.format(
+            base_path))
+
+    serial = read_serial(dev)
+
+    if base_serial.rstrip('\0') and \
+            base_serial.rstrip('\0') != serial.rstrip('\0'):
+        raise RuntimeError('"{0}" is an image of another device.'.format(
+            base_path))
+
+    reader = BlockReader(dev)
+
+    log = ''.join(reader.read(0, LOG_SIZE // BLOCK_SIZE))
+
+    areas = log_areas(base)
+    blocks = changed_blocks(areas, log_areas(log), last_records(base, areas))
+    blocks -= _region_blocks(0, LOG_SIZE)
+
+    data = [log]
+
+    addr = LOG_SIZE // BLOCK_SIZE
+
+    while addr < BLOCK_COUNT:
+
+        # Find the run of blocks that are all read or all copied.
+        end = addr + 1
+        while end < BLOCK_COUNT and (end in blocks) == (addr in blocks):
+            end += 1
+
+        if addr in blocks:
+            data.extend(reader.read(addr, end))
+        else:
+            data.append(base[addr * BLOCK_SIZE:end * BLOCK_SIZE])
+
+        addr = end
+
+    write_image(output, ''.join(data), sparse, serial, store)
+
+    print('Read {0} of {1} blocks.'.format(reader.blocks_read, BLOCK_COUNT))
 
 
 
@@ -136,6 +435,21 @@ def main():
     parser.add_argument('--device', '-D',
                         help='Path to the device. If not specified'
                              ' it will try to be autodetected.')
+    parser.add_argument('--incremental', metavar='BASE.dump',
+                        help='Only read the blocks that have changed since '
+                             'the dump BASE.dump was made. The output is '
+                             'still a complete dump.')
+    parser.add_argument('--sparse', action='store_true',
+                        help='Write a compressed image without the erased '
+                             'blocks instead of a raw image.')
+    parser.add_argument('--convert', metavar='IMAGE',
+                        help='Convert the image or manifest IMAGE instead '
+                             'of reading the device. Use --sparse to write '
+                             'a sparse image.')
+    parser.add_argument('--store', metavar='DIR',
+                        help='Keep the blocks in the block store DIR, which '
+                             'is shared between dumps, and write a manifest '
+                             'of the blocks to the output.')
 
 
     args = parser.parse_args()
@@ -143,12 +457,25 @@ def main():
     dev = args.device
 
     try:
+        if args.convert:
+            convert_image(args.convert, args.output, args.sparse,
+                          args.store)
+            return 0
+
+        if not has_py_sg:
+            print('You need to install the "py_sg" module.')
+            return 1
+
         if dev is None:
             dev = find_device()
 
         with open_device(dev) as dev:
 
-            dump_device(dev, args.output)
+            if args.incremental:
+                dump_device_incremental(dev, args.output, args.incremental,
+                                        args.sparse, args.store)
+            else:
+                dump_device(dev, args.output, args.sparse, args.store)
 
     except RuntimeError, e:
         print ('Error:', e.message)